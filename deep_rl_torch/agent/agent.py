@@ -11,7 +11,7 @@ from pytorch_memlab import LineProfiler, profile, profile_every, set_target_gpu
 # Internal Imports:
 from deep_rl_torch.nn import ProcessState, ProcessStateAction
 from deep_rl_torch.policies import Q_Policy, ActorCritic, REM, MineRLHierarchicalPolicy
-from deep_rl_torch.nn.nn_utils import count_parameters, count_model_parameters
+from deep_rl_torch.nn.nn_utils import count_parameters, count_model_parameters, zero_grad
 from deep_rl_torch.util import *
 
 try:
@@ -34,6 +34,9 @@ class Agent:
 
         self.updates_per_step = hyperparameters["updates_per_step"]
         self.optimize_centrally = hyperparameters["optimize_centrally"]
+        # Gradients of this many batches are accumulated before the norm is clipped and the optimizer steps:
+        self.accumulation_steps = hyperparameters["accumulation_steps"]
+        self.accumulated_steps = 0
         self.use_half = hyperparameters["use_half"] and torch.cuda.is_available()
         self.use_actor_critic = hyperparameters["use_actor_critic"]
         self.save_path = hyperparameters["save_path"]
@@ -87,7 +90,7 @@ class Agent:
         
 
     def init_feature_extractors(self):
-        state_sample = self.env.observation_space.sample()
+        state_sample = sample_obs_space_for_shapes(self.env.observation_space)
         if not self.use_list:
             state_sample = self.fake_stack(state_sample)
 
@@ -101,7 +104,7 @@ class Agent:
         #    F_s = amp.initialize(F_s, verbosity=0)
         F_sa = None
         if self.use_actor_critic:
-            state_feature_len = F_s.layers_merge[-1].out_features
+            state_feature_len = F_s.layers_merge.out_features
             F_sa = ProcessStateAction(state_feature_len, self.env, self.log, self.device, self.hyperparameters)
             if self.log and self.verbose:
                 print("F_sa:")
@@ -178,12 +181,19 @@ class Agent:
             if self.F_sa is not None:
                 all_nets.append(self.F_sa)
 
-            self.optimizer.zero_grad()
+            if self.accumulated_steps == 0:
+                zero_grad(self.optimizer)
+            if self.accumulation_steps > 1:
+                loss = loss / self.accumulation_steps
             self.backward(loss)
+            self.accumulated_steps += 1
+            if self.accumulated_steps < self.accumulation_steps:
+                return
+            self.accumulated_steps = 0
             # Scale the norm of gradients if necessary:
             for net in all_nets:
                 net.norm_gradient()
-                net.scale_gradient()
+                net.scale_gradient(self.accumulation_steps)
             # Scale gradient of networks according to how many outgoing networks it receives gradients from
             #self.F_s.scale_gradient()
             #if self.F_sa is not None:
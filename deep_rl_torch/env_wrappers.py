@@ -1,7 +1,8 @@
 import copy
+import tempfile
 import time
-from collections import OrderedDict, deque
-from logging import getLogger
+from collections import OrderedDict
+from logging import DEBUG, getLogger
 
 import cv2
 import gym
@@ -12,11 +13,28 @@ from gym.wrappers.monitoring.stats_recorder import StatsRecorder
 from gym import spaces
 import minerl
 
-from .util import apply_rec_to_dict, apply_to_state, apply_to_state_list
+from .util import apply_rec_to_dict, apply_to_state
+
+# Numba is optional - without it the preprocessing functions below simply run as plain NumPy code:
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 cv2.ocl.setUseOpenCL(False)
 logger = getLogger(__name__)
 
+_DICT_SPACE_TYPES = (dict, minerl.env.spaces.Dict)
+
+# Shared read-only camera actions, so that the discrete action tables do not hold a separate array per action:
+_ZERO_CAM2 = np.zeros((2,), np.float32)
+_ZERO_CAM2.setflags(write=False)
+_CAM_LEFT = np.array([0, -10], np.float32)
+_CAM_LEFT.setflags(write=False)
+_CAM_RIGHT = np.array([0, 10], np.float32)
+_CAM_RIGHT.setflags(write=False)
+
 
 def add_to_set_in_dict(dict_to_add, name, val):
     try:
@@ -25,25 +43,101 @@ def add_to_set_in_dict(dict_to_add, name, val):
         dict_to_add[name] = {val}
 
 
-def map2closest_val(val, number_list):
-    return min(number_list, key=lambda x: abs(x - val))
+def closest_option_idx(vals, options):
+    """Return the index of the closest entry in the sorted array `options` for a scalar or an array of values.
+    Ties are resolved towards the lower option."""
+    idxs = np.clip(np.searchsorted(options, vals), 1, len(options) - 1)
+    return np.where(vals - options[idxs - 1] <= options[idxs] - vals, idxs - 1, idxs)
+
+
+def frame_pool_size(num_transitions, k):
+    """Number of frames a FramePool needs so that none of the frames referenced by num_transitions stored transitions
+    is overwritten. Every step adds one frame and every reset one more, so in the worst case of one-step episodes the
+    stored transitions span 2 * num_transitions frames, plus the k frames of the oldest stack."""
+    return 2 * num_transitions + k + 1
+
+
+class FramePool:
+    def __init__(self, size, directory=None):
+        """Circular buffer that stores every frame only once.
+        LazyFrames only hold the ids of their frames in the pool, so neighbouring observations do not duplicate
+        their k-1 shared frames. The pool must be larger than the number of frames that are still referenced (e.g. by
+        the replay buffer, see frame_pool_size), otherwise old frames get overwritten. The ids count all frames ever
+        added, so reading an overwritten frame raises an IndexError instead of silently returning a newer frame.
+        If a directory (e.g. /dev/shm) is given, the frames are stored in a memory-mapped temporary file in it instead
+        of in RAM, which lets the OS page cache decide which frames stay in memory."""
+        self.size = size
+        self.directory = directory
+        self.frames = None
+        self.cursor = 0
+        self._file = None
+
+    def add(self, frame):
+        # Allocate lazily, as the shape and dtype are only known once the first frame arrives:
+        if self.frames is None:
+            shape = (self.size,) + frame.shape
+            if self.directory:
+                # The file is deleted once the pool is garbage collected:
+                self._file = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".frames")
+                self.frames = np.memmap(self._file, dtype=frame.dtype, mode="w+", shape=shape)
+            else:
+                self.frames = np.empty(shape, dtype=frame.dtype)
+        frame_id = self.cursor
+        self.frames[frame_id % self.size] = frame
+        self.cursor += 1
+        return frame_id
+
+    def __getitem__(self, frame_ids):
+        if self.cursor - np.min(frame_ids) > self.size:
+            raise IndexError("Frame %d was already overwritten in the FramePool of size %d. The pool is too small for "
+                             "the replay buffer." % (np.min(frame_ids), self.size))
+        return self.frames[frame_ids % self.size]
+
+
+def stack_pool_frames(frames, stack_dim):
+    # frames has shape (k, *frame_shape). Concatenating them along stack_dim is the same as moving the k axis in
+    # front of stack_dim and merging both axes:
+    stack_dim = stack_dim % (frames.ndim - 1)
+    shape = list(frames.shape[1:])
+    shape[stack_dim] *= frames.shape[0]
+    return np.moveaxis(frames, 0, stack_dim).reshape(shape)
+
+
+def make_pool_stacker(pools, stack_dim):
+    """Build a function that gathers the frames with the given ids from the pools and stacks them.
+    The structure of the observation is fixed for an env, so it is only walked through here once instead of on every
+    call."""
+    if isinstance(pools, dict):
+        stackers = [(key, make_pool_stacker(pool, stack_dim)) for key, pool in pools.items()]
+        return lambda idxs: {key: stacker(idxs) for key, stacker in stackers}
+    return lambda idxs: stack_pool_frames(pools[idxs], stack_dim)
 
 
 class FrameStack(gym.Wrapper):
-    def __init__(self, env, k, store_stacked, stack_dim=0):
+    def __init__(self, env, k, store_stacked, pool_size, stack_dim=0, pool_dir=None):
         """Stack k last frames.
         Returns lazy array, which is much more memory efficient.
+        pool_size is the number of frames kept in the FramePool. Use frame_pool_size to size it for the replay buffer.
+        If pool_dir is given, the FramePool is backed by a memory-mapped file in that directory.
         See Also
         --------
         baselines.common.atari_wrappers.LazyFrames
         """
         gym.Wrapper.__init__(self, env)
         self.k = k
-        self.frames = deque([], maxlen=k)
+        # Ring of the pool ids of the last k frames. The oldest frame is at self.pos % k:
+        self.frames = np.zeros(k, dtype=np.int64)
+        self.pos = 0
+        self._ring_offsets = np.arange(k)
         self.stack_dim = stack_dim
         self.store_stacked = store_stacked
+        self.pool_size = pool_size
+        self.pool_dir = pool_dir
+        # One FramePool per observation, or a dict of pools for dict observations. Created on reset:
+        self.pools = None
+        self._stacker = None
 
-        if isinstance(env.observation_space, dict) or isinstance(env.observation_space, minerl.env.spaces.Dict):
+        if isinstance(env.observation_space, _DICT_SPACE_TYPES):
             new_space = apply_rec_to_dict(self.transform_obs_space, env.observation_space)
             self.observation_space = ItObsDict(new_space)
         else:
@@ -63,31 +157,57 @@ class FrameStack(gym.Wrapper):
 
     def reset(self):
         ob = self.env.reset()
-        for _ in range(self.k):
-            self.frames.append(ob)
+        if self.pools is None:
+            self.pools = apply_to_state(lambda frame: FramePool(self.pool_size, self.pool_dir), ob)
+            self._stacker = make_pool_stacker(self.pools, self.stack_dim)
+        self.frames[:] = self.add_to_pools(ob)
+        self.pos = 0
         return self._get_ob()
 
     def step(self, action):
         ob, reward, done, info = self.env.step(action)
-        self.frames.append(ob)
+        # Overwrite the oldest frame:
+        self.frames[self.pos % self.k] = self.add_to_pools(ob)
+        self.pos += 1
         return self._get_ob(), reward, done, info
 
+    def add_to_pools(self, ob, pools=None):
+        if pools is None:
+            pools = self.pools
+        # All parts of a dict observation are written at the same time, so they share the same frame id:
+        if isinstance(ob, dict):
+            idxs = {self.add_to_pools(ob[key], pools[key]) for key in ob}
+            assert len(idxs) == 1
+            return idxs.pop()
+        return pools.add(self.to_numpy(ob))
+
+    @staticmethod
+    def to_numpy(frame):
+        # Frames are stored as NumPy arrays (sharing memory with CPU tensors) and only converted when stacked:
+        if isinstance(frame, torch.Tensor):
+            return frame.numpy()
+        return np.asarray(frame)
+
     def _get_ob(self):
-        assert len(self.frames) == self.k
-        return LazyFrames(list(self.frames), self.stack_dim, self.store_stacked)
+        # Fancy indexing gives the LazyFrames their own copy of the ids, ordered from oldest to newest:
+        idxs = self.frames[(self.pos + self._ring_offsets) % self.k]
+        return LazyFrames(idxs, self.pools, self._stacker, self.store_stacked)
 
 
 class LazyFrames:
-    def __init__(self, frames, stack_dim, store_stacked):
+    def __init__(self, idxs, pools, stacker, store_stacked):
         """This object ensures that common frames between the observations are only stored once.
         It exists purely to optimize memory usage which can be huge for DQN's 1M frames replay
         buffers.
+        The frames themselves live in a FramePool (or a dict of them), this object only stores their ids.
+        stacker is the function built by make_pool_stacker that turns the ids into the stacked observation.
         This object should only be converted to numpy array before being passed to the model.
         You'd not believe how complex the previous solution was."""
-        self._frames = frames
+        self._idxs = idxs
+        self._pools = pools
         self._out = None
-        self.obs_is_dict = isinstance(self._frames[0], dict)
-        self.stack_dim = stack_dim
+        self._stacker = stacker
+        self.obs_is_dict = isinstance(self._pools, dict)
         self.store_stacked = store_stacked
 
     def _force(self):
@@ -98,49 +218,40 @@ class LazyFrames:
             #    self._frames = None
             #return self._out
         else:
-            return self.stack_frames(self._frames)
+            return self.stack_frames(self._idxs)
 
-    def stack_frames(self, frames):
-        obs = apply_to_state_list(self.stack, frames)
-        return obs
-        #if self.obs_is_dict:
-        #    obs = {
-        #        self.stack([frame[key] for frame in frames])
-        #        for key in frames[0]
-        #    }
-        #else:
-        #    obs = self.stack(frames)
-        #return obs
-
-    def stack(self, frames):
-        return torch.cat(list(frames), dim=self.stack_dim)
+    def stack_frames(self, idxs):
+        return self._stacker(idxs)
 
     def make_state(self):
-        return self._force()
+        # Convert to torch only when the state is actually needed, e.g. when a batch is sampled:
+        return apply_to_state(torch.from_numpy, self._force())
+
+    def _log_access(self, name):
+        # These accessors are not meant to be used during training, so only report them when debugging:
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("LazyFrames accessed via %s", name)
 
     def __array__(self, dtype=None):
-        print("Access forbidden array")
-        out = self._force()
-        if dtype is not None:
-            out = out.type(dtype)
+        self._log_access("__array__")
+        out = np.ascontiguousarray(self._force(), dtype=dtype)
         return out
 
     def __len__(self):
-        print("Access forbidden len")
-        return len(self._force())
+        # The number of stacked frames, known without stacking them:
+        return len(self._idxs)
 
     def __getitem__(self, i):
-        print("Access forbidden getitem")
-        #return self._force()[i]
-        return self._frames[i]
+        # A view on the i-th frame of the stack:
+        return apply_to_state(lambda pool: pool[self._idxs[i]], self._pools)
 
     def count(self):
-        print("Access forbidden count")
+        self._log_access("count")
         frames = self._force()
         return frames.shape[frames.ndim - 1]
 
     def frame(self, i):
-        print("Access forbidden frame")
+        self._log_access("frame")
         return self._force()[..., i]
 
 
@@ -167,6 +278,13 @@ class HierarchicalActionWrapper(gym.ActionWrapper):
     """
 
     BINARY_KEYS = ['forward', 'back', 'left', 'right', 'jump', 'sneak', 'sprint', 'attack']
+    # Keys that are packed into the integer key of the dict -> idx lookup table. 'sneak' and 'sprint' are constant
+    # over all discrete actions, so they are not part of the key:
+    LUT_BINARY_KEYS = ('forward', 'back', 'left', 'right', 'jump', 'attack')
+    LUT_ITEM_KEYS = ('place', 'equip', 'craft', 'nearbyCraft', 'nearbySmelt')
+    # Fixed key order of the action tuples in dict2id_set, so they don't need to be sorted:
+    _KEY_ORDER = ('forward', 'back', 'left', 'right', 'jump', 'sneak', 'sprint', 'attack', 'camera', 'place', 'equip',
+                  'craft', 'nearbyCraft', 'nearbySmelt')
 
     def __init__(self, env, always_keys=None, reverse_keys=None, exclude_keys=None, exclude_noop=True, env_name=""):
         super().__init__(env)
@@ -230,7 +348,10 @@ class HierarchicalActionWrapper(gym.ActionWrapper):
                 raise ValueError('unknown exclude_keys: {}'.format(key))
         logger.info('always ignored keys: {}'.format(self.exclude_keys))
 
-        # get each discrete action
+        # get each discrete action. The actions are filled from the noop items instead of deep-copying the noop:
+        noop_items = tuple(self.noop.items())
+        # Every action gets its camera as a float32 array that is created only once here:
+        noop_camera = np.asarray(self.noop["camera"], dtype=np.float32)
         self._actions = [self.noop]
         idx = 0
 
@@ -253,6 +374,23 @@ class HierarchicalActionWrapper(gym.ActionWrapper):
             self.straight_options = ["forward"]
             self.lateral_options = ["none_lateral"]
 
+        # Lookup table from packed integer keys to action idxs. Layout of a key (from the lowest bit upwards):
+        # one bit per LUT_BINARY_KEY, the camera x and y option idxs, and a single item code for the exclusive
+        # place/equip/craft/nearbyCraft/nearbySmelt actions (0 means none of them is used):
+        self._camera_x_arr = np.asarray(self.camera_x_options)
+        self._camera_y_arr = np.asarray(self.camera_y_options)
+        self._item_offsets = {}
+        num_item_codes = 1
+        for key in self.LUT_ITEM_KEYS:
+            if key in self.noop:
+                self._item_offsets[key] = num_item_codes - 1
+                num_item_codes += self.wrapping_action_space.spaces[key].n - 1
+        camera_bits = (self.num_camera_actions - 1).bit_length()
+        self._camera_x_shift = len(self.LUT_BINARY_KEYS)
+        self._camera_y_shift = self._camera_x_shift + camera_bits
+        self._item_shift = self._camera_y_shift + camera_bits
+        self._action_lut = np.full(2 ** (self._item_shift + (num_item_codes - 1).bit_length()), -1, dtype=np.int32)
+
         # Create move possibilities:
         for lateral in self.lateral_options:
             for straight in self.straight_options:
@@ -269,7 +407,7 @@ class HierarchicalActionWrapper(gym.ActionWrapper):
                                 # add_to_set_in_dict(self.word2idx_set, camera_name, idx)
 
                                 # Create op that maps from idx to dict:
-                                op = copy.deepcopy(self.noop)
+                                op = OrderedDict(noop_items)
                                 if lateral != "none_lateral":
                                     op[lateral] = 1
                                 if straight != "none_straight":
@@ -278,11 +416,12 @@ class HierarchicalActionWrapper(gym.ActionWrapper):
                                     op[attack] = 1
                                 if jump != "none_jump":
                                     op[jump] = 1
-                                op["camera"] = (camera_x, camera_y)
+                                op["camera"] = np.array([camera_x, camera_y], dtype=np.float32)
                                 # For idx to dict:
                                 self._actions.append(op)
                                 # For dict to idx:
-                                self.dict2id_set[tuple(sorted(op.items()))] = idx
+                                self.dict2id_set[self._dict_key(op)] = idx
+                                self._action_lut[self._pack_action(op)] = idx
 
                                 idx += 1
 
@@ -298,80 +437,93 @@ class HierarchicalActionWrapper(gym.ActionWrapper):
                     add_to_set_in_dict(self.word2idx_set, name, idx)
 
                     # Idx to dict:
-                    op = copy.deepcopy(self.noop)
+                    op = OrderedDict(noop_items)
                     op[key] = a
+                    op["camera"] = noop_camera
                     self._actions.append(op)
 
-                    op["camera"] = tuple(op["camera"])
-                    self.dict2id_set[tuple(sorted(op.items()))] = idx
+                    self.dict2id_set[self._dict_key(op)] = idx
+                    self._action_lut[self._pack_action(op)] = idx
 
                     idx += 1
             else:
                 continue
         if self.exclude_noop:
             del self._actions[0]
+        # The action dicts are returned as they are by action(), so they must not be modified by the caller:
+        self._actions = tuple(self._actions)
         n = len(self._actions)
         self.n = n
         self.action_space = gym.spaces.Discrete(n)
         logger.info('{} is converted to {}.'.format(self.wrapping_action_space, self.action_space))
+        # Bound once, to avoid the attribute lookups on every step:
+        self._contains = self.action_space.contains
 
     def action(self, action):
-        if not self.action_space.contains(action):
+        if not self._contains(action):
             raise ValueError('action {} is invalid for {}'.format(action, self.action_space))
 
         original_space_action = self._actions[action]
-        logger.debug('discrete action {} -> original action {}'.format(action, original_space_action))
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('discrete action %s -> original action %s', action, original_space_action)
         return original_space_action
 
     def dicts2idxs(self, action_dict_iterable):
         return [self.dict2idx(action_dict) for action_dict in action_dict_iterable]
 
+    def dicts2idxs_batch(self, actions):
+        """Vectorized version of dict2idx for a dict of action arrays of length N (as returned by the MineRL data
+        pipeline), where the camera is an array of shape (N, 2). Returns an np.int32 array of N action idxs."""
+        cameras = np.asarray(actions["camera"]).reshape(-1, 2)
+        keys = closest_option_idx(cameras[:, 0], self._camera_x_arr) << self._camera_x_shift
+        keys |= closest_option_idx(cameras[:, 1], self._camera_y_arr) << self._camera_y_shift
+        for bit, name in enumerate(self.LUT_BINARY_KEYS):
+            if name in actions:
+                keys |= (np.asarray(actions[name]).reshape(-1) != 0).astype(keys.dtype) << bit
+        items = np.zeros_like(keys)
+        num_items = np.zeros_like(keys)
+        for name, offset in self._item_offsets.items():
+            if name in actions:
+                vals = np.asarray(actions[name]).reshape(-1).astype(keys.dtype)
+                used = vals != 0
+                items += np.where(used, offset + vals, 0)
+                num_items += used
+        combined_items = num_items > 1
+        idxs = self._action_lut[keys | (np.where(combined_items, 0, items) << self._item_shift)]
+        invalid = np.flatnonzero((idxs < 0) | combined_items)
+        if len(invalid):
+            raise KeyError('No discrete action corresponds to the action at position {}'.format(invalid[0]))
+        return idxs
+
     def dict2idx(self, action_dict):
-        action_dict_copy = action_dict.copy()
-        x = action_dict["camera"][0]
-        y = action_dict["camera"][1]
-        mapped_camera = (map2closest_val(x, self.camera_x_options), map2closest_val(y, self.camera_y_options))
-        action_dict_copy["camera"] = mapped_camera
-        return self.dict2id_set[tuple(sorted(action_dict_copy.items()))]
-
-    def dict2idx_old(self, action_dict):
-        possible_idxs = None
-        for key in action_dict:
-            val = action_dict[key]
-            name = key
-            # For camera:
-            if key == "camera":
-                x = map2closest_val(val[0], self.camera_x_options)
-                y = map2closest_val(val[1], self.camera_y_options)
-                name += "_" + str(x) + "_" + str(y)
-            # For other keys:
-            elif key in ('place', 'equip', 'craft', 'nearbyCraft', 'nearbySmelt'):
-                # Only one idx per place value, so it is easy to match:
-                if val:
-                    name = key + str(val)
-                    idx = self.word2idx_set[name][0]
-                    return idx
-            else:
-                if val:
-                    name = key
-                else:
-                    if key == "left" or key == "right":
-                        name = "none_lateral"
-                    elif key == "forward" or key == "backward":
-                        name = "none_straight"
-                    elif key == "jump":
-                        name = "none_jump"
-                    elif key == "attack":
-                        name = "none_attack"
-                new_idxs = self.word2idx_set[name]
-                # Repeatedly take the intersection of possible values until only one idx is left:
-                if possible_idxs is None:
-                    possible_idxs = new_idxs
-                else:
-                    possible_idxs = possible_idxs.intersection(new_idxs)
-                    # If only one more is possible:
-                    if len(possible_idxs) == 1:
-                        return possible_idxs[0]
+        key = self._pack_action(action_dict)
+        idx = -1 if key is None else self._action_lut[key]
+        if idx < 0:
+            raise KeyError('No discrete action corresponds to {}'.format(action_dict))
+        return int(idx)
+
+    def _pack_action(self, action_dict):
+        """Pack an action dict into an integer key of the lookup table. The camera is mapped to the closest option.
+        Returns None if the dict combines several place/equip/craft/nearbyCraft/nearbySmelt actions."""
+        key = 0
+        for bit, name in enumerate(self.LUT_BINARY_KEYS):
+            if action_dict.get(name, 0):
+                key |= 1 << bit
+        camera = action_dict["camera"]
+        key |= int(closest_option_idx(camera[0], self._camera_x_arr)) << self._camera_x_shift
+        key |= int(closest_option_idx(camera[1], self._camera_y_arr)) << self._camera_y_shift
+        item = 0
+        for name, offset in self._item_offsets.items():
+            val = action_dict.get(name, 0)
+            if val:
+                if item:
+                    return None
+                item = offset + int(val)
+        return key | (item << self._item_shift)
+
+    def _dict_key(self, action_dict):
+        return tuple(tuple(action_dict[key]) if key == "camera" else action_dict.get(key, 0)
+                     for key in self._KEY_ORDER)
 
 
 class FrameSkip(gym.Wrapper):
@@ -387,8 +539,9 @@ class FrameSkip(gym.Wrapper):
 
     def step(self, action):
         total_reward = 0.0
+        env_step = self.env.step
         for _ in range(self._skip):
-            obs, reward, done, info = self.env.step(action)
+            obs, reward, done, info = env_step(action)
             total_reward += reward
             if done:
                 break
@@ -417,17 +570,35 @@ def one_hot_encode_single(number, num_actions):
     return y
 
 
+@njit(cache=True, nogil=True)
+def _rgb2gray(frame):
+    """Rounded channel mean of an HWC uint8 frame, returned with shape (1, H, W).
+    (r + g + b) / 3 never lies exactly between two integers, so the integer rounding is exact."""
+    # Whole-array integer ops instead of a per-pixel loop, so this stays fast when numba is not installed:
+    total = frame[:, :, 0].astype(np.int32) + frame[:, :, 1] + frame[:, :, 2]
+    gray = ((total + 1) // 3).astype(np.uint8)
+    return gray.reshape((1, frame.shape[0], frame.shape[1]))
+
+
+@njit(cache=True, nogil=True)
+def _process_equipped(damage, max_damage, obj_type):
+    out = np.zeros(11, dtype=np.float32)
+    out[0] = damage
+    out[1] = max_damage
+    # One-hot encoding of the item type:
+    out[2 + obj_type] = 1.0
+    return out
+
+
 def process_equipped(mainhand_dict):
-    dmg = torch.tensor(mainhand_dict["damage"], dtype=torch.float).unsqueeze(0)
-    max_dmg = torch.tensor(mainhand_dict["maxDamage"], dtype=torch.float).unsqueeze(0)
     obj_type = mainhand_dict["type"]
     if np.any(obj_type != 0):
         possible_non_none_types = ("air", "wooden_axe", "wooden_pickaxe", "stone_axe", "stone_pickaxe", "iron_axe",
                                    "iron_pickaxe")
         if obj_type != 0 and obj_type not in range(1, 8) and obj_type not in possible_non_none_types:
             obj_type = 8
-    item_type = one_hot_encode_single(obj_type, 9)
-    return torch.cat([dmg, max_dmg, item_type], dim=0)
+    out = _process_equipped(float(mainhand_dict["damage"]), float(mainhand_dict["maxDamage"]), int(obj_type))
+    return torch.from_numpy(out)
 
 
 class DefaultWrapper(gym.ObservationWrapper):
@@ -479,15 +650,16 @@ class Convert2TorchWrapper(gym.ObservationWrapper):
             elif key == "inventory":
                 inv_dict = obs_dict[key]
                 # obs = torch.cat([torch.from_numpy(process_inv(inv_dict)).float() for inv_dict in inv_dict_list])
-                obs = torch.cat(
-                        [torch.from_numpy(np.ascontiguousarray(inv_dict[key])) for key in inv_dict])
+                # Concatenate in NumPy to create a single tensor instead of one per item. The item counts of the
+                # env are 0-d arrays, so they are made 1-d first:
+                obs = torch.from_numpy(np.concatenate([np.atleast_1d(inv_dict[key]) for key in inv_dict]))
             elif key == "pov":
-                obs = torch.from_numpy(np.ascontiguousarray(obs_dict[key]))
+                # Write the processed frame straight into a single new uint8 tensor:
                 if self.rgb2gray:
-                    obs = np.round(obs.float().mean(dim=-1)).unsqueeze(0)
+                    obs = torch.from_numpy(_rgb2gray(np.asarray(obs_dict[key], dtype=np.uint8)))
                 else:
-                    obs = obs.permute(2, 0, 1)
-                obs = obs.byte().clone()
+                    frame = torch.as_tensor(obs_dict[key]).permute(2, 0, 1)
+                    obs = torch.empty(frame.shape, dtype=torch.uint8).copy_(frame)
             elif key == "compassAngle":
                 obs = torch.tensor(obs_dict[key], dtype=torch.float).unsqueeze(0)
             else:
@@ -500,6 +672,17 @@ class Convert2TorchWrapper(gym.ObservationWrapper):
         return new_obs
 
 
+@njit(cache=True, nogil=True)
+def _atari_preprocess(obs, last_obs, rgb2gray):
+    frame = obs[35:195:2, ::2]
+    if last_obs is not None:
+        frame = np.maximum(last_obs, frame)  # kill object flickering
+
+    if not rgb2gray:
+        return frame.copy()
+    return _rgb2gray(frame)
+
+
 class AtariObsWrapper(gym.ObservationWrapper):
     def __init__(self, env, rgb2gray):
         super().__init__(env)
@@ -508,25 +691,21 @@ class AtariObsWrapper(gym.ObservationWrapper):
         self.observation_space = spaces.Box(low=0, high=255, shape=(1, 80, 80), dtype=env.observation_space.dtype)
 
     def observation(self, obs):
-        obs = torch.from_numpy(np.ascontiguousarray(obs))
-        obs = obs[35:195]
-        obs = obs[::2, ::2]
-        if self.last_obs:
-            obs = torch.max(self.last_obs, obs)  # kill object flickering
-
-        if self.rgb2gray:
-            obs = np.round(obs.float().mean(dim=-1)).unsqueeze(0)
-        else:
-            obs.permute(2, 0, 1)
-        obs = obs.byte().clone().unsqueeze(0)
-
-        return obs
+        obs = _atari_preprocess(np.ascontiguousarray(obs, dtype=np.uint8), self.last_obs, self.rgb2gray)
+        return torch.from_numpy(obs).unsqueeze(0)
 
     def reset(self):
         self.last_obs = None
         return super().reset()
 
 
+# Compile the preprocessing functions once at import instead of during the first environment step:
+_process_equipped(0.0, 0.0, 0)
+_rgb2gray(np.zeros((64, 64, 3), dtype=np.uint8))
+_atari_preprocess(np.zeros((210, 160, 3), dtype=np.uint8), None, True)
+_atari_preprocess(np.zeros((210, 160, 3), dtype=np.uint8), None, False)
+
+
 class PoVWithCompassAngleWrapper(gym.ObservationWrapper):
     """Take 'pov' value (current game display) and concatenate compass angle information with it, as a new channel of image;
     resulting image has RGB+compass (or K+compass for gray-scaled image) channels.
@@ -548,8 +727,12 @@ class PoVWithCompassAngleWrapper(gym.ObservationWrapper):
     def observation(self, observation):
         pov = observation['pov']
         compass_scaled = observation['compassAngle'] / self._compass_angle_scale
-        compass_channel = np.ones(shape=list(pov.shape[:-1]) + [1], dtype=pov.dtype) * compass_scaled
-        return np.concatenate([pov, compass_channel], axis=-1)
+        # Write pov and compass channel into one output array. A new array is needed on every call, as the
+        # observations (and the low/high bounds computed in __init__) are kept around:
+        out = np.empty(pov.shape[:-1] + (pov.shape[-1] + 1,), dtype=np.result_type(pov, compass_scaled))
+        out[..., :-1] = pov
+        out[..., -1] = compass_scaled
+        return out
 
 
 class MoveAxisWrapper(gym.ObservationWrapper):
@@ -601,8 +784,11 @@ class GrayScaleWrapper(gym.ObservationWrapper):
             frame = obs
         else:
             frame = obs[self._key]
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        frame = np.expand_dims(frame, -1)
+        # cvtColor writes straight into the (height, width, 1) output. It is a new array on every step, as the returned
+        # observations may be kept around:
+        gray = np.empty(frame.shape[:2] + (1,), dtype=np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=gray)
+        frame = gray
         if self._key is None:
             obs = frame
         else:
@@ -697,14 +883,17 @@ class SerialDiscreteActionWrapper(gym.ActionWrapper):
                 raise ValueError('unknown exclude_keys: {}'.format(key))
         logger.info('always ignored keys: {}'.format(self.exclude_keys))
 
-        # get each discrete action
+        # get each discrete action. The actions are filled from the noop items instead of deep-copying the noop:
+        if "camera" in self.noop:
+            self.noop["camera"] = _ZERO_CAM2
+        noop_items = tuple(self.noop.items())
         self._actions = [self.noop]
         for key in self.noop:
             if key in self.always_keys or key in self.exclude_keys:
                 continue
             if key in self.BINARY_KEYS:
                 # action candidate : {1}  (0 is ignored because it is for noop), or {0} when `reverse_keys`.
-                op = copy.deepcopy(self.noop)
+                op = OrderedDict(noop_items)
                 if key in self.reverse_keys:
                     op[key] = 0
                 else:
@@ -714,34 +903,49 @@ class SerialDiscreteActionWrapper(gym.ActionWrapper):
                 self._actions.append(op)
             elif key == 'camera':
                 # action candidate : {[0, -10], [0, 10]}
-                op = copy.deepcopy(self.noop)
-                op[key] = np.array([0, -10], dtype=np.float32)
+                op = OrderedDict(noop_items)
+                op[key] = _CAM_LEFT
                 self._actions.append(op)
-                op = copy.deepcopy(self.noop)
-                op[key] = np.array([0, 10], dtype=np.float32)
+                op = OrderedDict(noop_items)
+                op[key] = _CAM_RIGHT
                 self._actions.append(op)
             elif key in {'place', 'equip', 'craft', 'nearbyCraft', 'nearbySmelt'}:
                 # action candidate : {1, 2, ..., len(space)-1}  (0 is ignored because it is for noop)
                 for a in range(1, self.wrapping_action_space.spaces[key].n):
-                    op = copy.deepcopy(self.noop)
+                    op = OrderedDict(noop_items)
                     op[key] = a
                     self._actions.append(op)
-            print(key, op[key])
+            logger.debug('last discrete action for %s: %s', key, op[key])
         if self.exclude_noop:
             del self._actions[0]
         n = len(self._actions)
         self.action_space = gym.spaces.Discrete(n)
         logger.info('{} is converted to {}.'.format(self.wrapping_action_space, self.action_space))
+        # Bound once, to avoid the attribute lookups on every step:
+        self._contains = self.action_space.contains
 
     def action(self, action):
-        if not self.action_space.contains(action):
+        if not self._contains(action):
             raise ValueError('action {} is invalid for {}'.format(action, self.action_space))
 
         original_space_action = self._actions[action]
-        logger.debug('discrete action {} -> original action {}'.format(action, original_space_action))
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('discrete action %s -> original action %s', action, original_space_action)
         return original_space_action
 
 
+def combined_noop():
+    """The noop action of the action space created by CombineActionWrapper."""
+    return OrderedDict([
+        ('forward_back', 0),
+        ('left_right', 0),
+        ('jump', 0),
+        ('sneak_sprint', 0),
+        ('camera', _ZERO_CAM2),
+        ('attack_place_equip_craft_nearbyCraft_nearbySmelt', 0),
+    ])
+
+
 class CombineActionWrapper(gym.ActionWrapper):
     """Combine MineRL env's "exclusive" actions.
 
@@ -774,7 +978,7 @@ class CombineActionWrapper(gym.ActionWrapper):
             for key in valid_action_keys:
                 space = self.wrapping_action_space.spaces[key]
                 for i in range(1, space.n):
-                    op = copy.deepcopy(noop)
+                    op = dict(noop)
                     op[key] = i
                     new_actions.append(op)
             return new_key, new_actions
@@ -786,14 +990,7 @@ class CombineActionWrapper(gym.ActionWrapper):
             new_key, new_actions = combine_exclusive_actions(keys)
             self._maps[new_key] = new_actions
 
-        self.noop = OrderedDict([
-            ('forward_back', 0),
-            ('left_right', 0),
-            ('jump', 0),
-            ('sneak_sprint', 0),
-            ('camera', np.zeros((2,), dtype=np.float32)),
-            ('attack_place_equip_craft_nearbyCraft_nearbySmelt', 0),
-        ])
+        self.noop = combined_noop()
 
         self.action_space = gym.spaces.Dict({
             'forward_back':
@@ -810,25 +1007,42 @@ class CombineActionWrapper(gym.ActionWrapper):
                 gym.spaces.Discrete(len(self._maps['attack_place_equip_craft_nearbyCraft_nearbySmelt']))
         })
 
+        self._action_fn = self._create_action_fn()
+        # Bound once, to avoid the attribute lookups on every step:
+        self._contains = self.action_space.contains
+
         logger.info('{} is converted to {}.'.format(self.wrapping_action_space, self.action_space))
         for k, v in self._maps.items():
             logger.info('{} -> {}'.format(k, v))
 
     def action(self, action):
-        if not self.action_space.contains(action):
+        # Validating the whole Dict space is slow, so only do it when debugging:
+        debug = logger.isEnabledFor(DEBUG)
+        if debug and not self._contains(action):
             raise ValueError('action {} is invalid for {}'.format(action, self.action_space))
 
-        original_space_action = OrderedDict()
-        for k, v in action.items():
-            if k in self._maps:
-                a = self._maps[k][v]
-                original_space_action.update(a)
-            else:
-                original_space_action[k] = v
+        original_space_action = self._action_fn(action, self._maps)
 
-        logger.debug('action {} -> original action {}'.format(action, original_space_action))
+        if debug:
+            logger.debug('action %s -> original action %s', action, original_space_action)
         return original_space_action
 
+    def _create_action_fn(self):
+        """Generate a function that converts a combined action into the original one with one line per key.
+        The keys of the action space are fixed, so this avoids iterating over the action and looking up each key in
+        self._maps on every step."""
+        lines = ["def combined2original(action, maps):",
+                 "    out = OrderedDict()"]
+        for key in self.noop:
+            if key in self._maps:
+                lines.append("    out.update(maps[{0!r}][action[{0!r}]])".format(key))
+            else:
+                lines.append("    out[{0!r}] = action[{0!r}]".format(key))
+        lines.append("    return out")
+        namespace = {"OrderedDict": OrderedDict}
+        exec("\n".join(lines), namespace)
+        return namespace["combined2original"]
+
 
 class SerialDiscreteCombineActionWrapper(gym.ActionWrapper):
     def __init__(self, env):
@@ -836,40 +1050,68 @@ class SerialDiscreteCombineActionWrapper(gym.ActionWrapper):
 
         self.wrapping_action_space = self.env.action_space
 
-        self.noop = OrderedDict([
-            ('forward_back', 0),
-            ('left_right', 0),
-            ('jump', 0),
-            ('sneak_sprint', 0),
-            ('camera', np.zeros((2,), dtype=np.float32)),
-            ('attack_place_equip_craft_nearbyCraft_nearbySmelt', 0),
-        ])
+        self.noop = combined_noop()
 
-        # get each discrete action
-        self._actions = [self.noop]
-        for key in self.noop:
+        # Number of actions: the noop, two camera actions and every non-zero value of the discrete keys:
+        self._dict_keys = tuple(self.noop)
+        self._disc_keys = tuple(key for key in self._dict_keys if key != 'camera')
+        n = 3 + sum(self.wrapping_action_space.spaces[key].n - 1 for key in self._disc_keys)
+
+        # Store the actions as rows of an int table for the discrete keys and a read-only float table for the camera:
+        self._disc = np.zeros((n, len(self._disc_keys)), dtype=np.int32)
+        self._cam = np.zeros((n, 2), dtype=np.float32)
+        idx = 1
+        for key in self._dict_keys:
             if key == 'camera':
                 # action candidate : {[0, -10], [0, 10]}
-                op = copy.deepcopy(self.noop)
-                op[key] = np.array([0, -10], dtype=np.float32)
-                self._actions.append(op)
-                op = copy.deepcopy(self.noop)
-                op[key] = np.array([0, 10], dtype=np.float32)
-                self._actions.append(op)
+                self._cam[idx] = (0, -10)
+                self._cam[idx + 1] = (0, 10)
+                idx += 2
             else:
+                column = self._disc_keys.index(key)
                 for a in range(1, self.wrapping_action_space.spaces[key].n):
-                    op = copy.deepcopy(self.noop)
-                    op[key] = a
-                    self._actions.append(op)
-
+                    self._disc[idx, column] = a
+                    idx += 1
+        self._cam.setflags(write=False)
+
+        # The action dicts are built once from the tables. Their camera arrays are views into the camera table. They
+        # are returned as they are by action(), so they must not be modified by the caller:
+        actions = [None] * n
+        for idx in range(n):
+            actions[idx] = self._row2dict(idx)
+        self._actions = tuple(actions)
+        self.noop = self._actions[0]
         n = len(self._actions)
+        self.n = n
         self.action_space = gym.spaces.Discrete(n)
         logger.info('{} is converted to {}.'.format(self.wrapping_action_space, self.action_space))
+        # Bound once, to avoid the attribute lookups on every step:
+        self._contains = self.action_space.contains
 
     def action(self, action):
-        if not self.action_space.contains(action):
-            raise ValueError('action {} is invalid for {}'.format(action, self.action_space))
+        # Fast path for plain ints, other types (e.g. NumPy ints) are checked by the slower Discrete.contains:
+        if not (type(action) is int and 0 <= action < self.n):
+            if not self._contains(action):
+                raise ValueError('action {} is invalid for {}'.format(action, self.action_space))
 
         original_space_action = self._actions[action]
-        logger.debug('discrete action {} -> original action {}'.format(action, original_space_action))
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('discrete action %s -> original action %s', action, original_space_action)
         return original_space_action
+
+    def actions2arrays(self, actions):
+        """Look up an array of discrete actions at once. Returns a dict of arrays in the original action format, with
+        the camera as an array of shape (N, 2)."""
+        actions = np.asarray(actions)
+        arrays = {key: self._disc[actions, j] for j, key in enumerate(self._disc_keys)}
+        arrays['camera'] = self._cam[actions]
+        return arrays
+
+    def _row2dict(self, idx):
+        op = OrderedDict()
+        for key in self._dict_keys:
+            if key == 'camera':
+                op[key] = self._cam[idx]
+            else:
+                op[key] = int(self._disc[idx, self._disc_keys.index(key)])
+        return op
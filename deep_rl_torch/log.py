@@ -15,7 +15,7 @@ class Log(object):
             self.writer = SummaryWriter(comment=comment)#, log_dir=os.path.join(wd, "runs/"))#, log_dir="runs/" + env_name)
         self.episodic_storage = {}
         self.storage = {}  # Stores all infos for later plotting
-        self.short_term_storage = defaultdict(int)  # Calculates running mean
+        self.short_term_storage = defaultdict(int)  # Sums up values for the running mean
         self.short_term_count = defaultdict(int)  # Counts for calculating running mean
         self.distr_count = defaultdict(int)  # Count for make_distribution to check when enough sample are gathered
         self.step_dict = defaultdict(list)  # Saves for each variable when the values where logged
@@ -32,7 +32,7 @@ class Log(object):
             self.writer = SummaryWriter(comment=self.comment)#, log_dir=os.path.join(wd, "runs/"))#, log_dir="runs/" + env_name)
         self.episodic_storage = {}
         self.storage = {}  # Stores all infos for later plotting
-        self.short_term_storage = defaultdict(int)  # Calculates running mean
+        self.short_term_storage = defaultdict(int)  # Sums up values for the running mean
         self.short_term_count = defaultdict(int)  # Counts for calculating running mean
         self.distr_count = defaultdict(int)  # Count for make_distribution to check when enough sample are gathered
         self.step_dict = defaultdict(list)  # Saves for each variable when the values where logged
@@ -86,12 +86,13 @@ class Log(object):
         except KeyError:
             storage[name] = [value]
 
-    def calc_running_mean(self, name, value):
-        n = self.short_term_count[name]
+    def add_to_running_sum(self, name, value):
+        # Only the sum is kept and divided by the count when the mean is written out. For tensors this is a single
+        # addition per step and the device is only synchronized once the mean is actually logged:
         storage = self.short_term_storage
         if name in storage:
-            value = (storage[name] * (n - 1) + value) / n
-        return value
+            value = storage[name] + value
+        storage[name] = value
 
     def do_save_log(self, name, use_skip, skip_steps=0, factor=1, make_distr=False, distr_steps=0):
         if make_distr:
@@ -129,12 +130,14 @@ class Log(object):
                     self.short_term_storage[name].append(value)
 
             else:
-                self.short_term_storage[name] = self.calc_running_mean(name, value)
+                self.add_to_running_sum(name, value)
 
             if self.do_save_log(name, use_skip, skip_steps=skip_steps, make_distr=make_distr,
                                 distr_steps=distr_steps):
                 # Get value to store long term:
                 tb_value = self.short_term_storage[name]
+                if not make_distr:
+                    tb_value = tb_value / self.short_term_count[name]
                 if not isinstance(tb_value, torch.Tensor):
                     tb_value = torch.tensor(tb_value)
                 tb_value = tb_value.detach()
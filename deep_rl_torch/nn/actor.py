@@ -1,15 +1,65 @@
-from .networks import OptimizableNet
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+
+from .networks import OptimizableNet, smooth_l1_loss_weighted
+from .nn_utils import clamp_to_bounds, create_ff_layers, zero_grad
+
+
+class ActorCore(torch.nn.Module):
+    """The layers and the output activations of the actor. Holds only tensor ops, so it can be compiled with
+    torch.jit.script to skip the Python overhead of the per-step action sampling."""
+    def __init__(self, layers, discrete, relu_idxs, sigmoid_idxs, tanh_idxs, scaling, offset):
+        super(ActorCore, self).__init__()
+        self.layers = layers
+        self.discrete = discrete
+        self.use_relu = len(relu_idxs) > 0
+        self.use_sigmoid = len(sigmoid_idxs) > 0
+        self.use_tanh = len(tanh_idxs) > 0
+        # Masks of shape (1, num_actions) that select the activation of every action dim. As buffers the masks and the
+        # scaling move along with the network by .to():
+        self.register_buffer("relu_mask", self.idxs2mask(relu_idxs, len(scaling)))
+        self.register_buffer("sigmoid_mask", self.idxs2mask(sigmoid_idxs, len(scaling)))
+        self.register_buffer("tanh_mask", self.idxs2mask(tanh_idxs, len(scaling)))
+        self.register_buffer("scaling", scaling)
+        self.register_buffer("offset", offset)
+
+    @staticmethod
+    def idxs2mask(idxs, num_actions):
+        mask = torch.zeros(1, num_actions, dtype=torch.bool)
+        mask[:, idxs] = True
+        return mask
+
+    def forward(self, x):
+        # Upcast in case the layers ran in autocast, so that the activations and the action scaling are computed in
+        # full precision:
+        x = self.layers(x).float()
+        if self.discrete:
+            return torch.sigmoid(x)
+        # Blend the activations with masks instead of scattering into slices, which keeps the gradient of all dims
+        # and only takes a few elementwise kernels:
+        if self.use_relu:
+            x = torch.where(self.relu_mask, F.relu(x), x)
+        if self.use_sigmoid:
+            x = torch.where(self.sigmoid_mask, torch.sigmoid(x), x)
+        if self.use_tanh:
+            x = torch.where(self.tanh_mask, torch.tanh(x), x)
+        return torch.addcmul(self.offset, x, self.scaling)
+
 
 class Actor(OptimizableNet):
     def __init__(self, F_s, env, log, device, hyperparameters, is_target_net=False):
         super(Actor, self).__init__(env, device, log, hyperparameters, is_target_net=is_target_net)
 
         self.name = "Actor"
+        # The per-sample losses of the actor are only used for the PER priorities:
+        self.need_sample_losses = hyperparameters["use_PER"]
 
         # Initiate arrays for output function:
-        self.relu_mask = None
-        self.sigmoid_mask = None
-        self.tanh_mask = None
         self.relu_idxs = None
         self.tanh_idxs = None
         self.sigmoid_idxs = None
@@ -17,13 +67,34 @@ class Actor(OptimizableNet):
         self.offset = None
 
         # Create layers
-        input_size = F_s.layers_merge[-1].out_features
+        input_size = F_s.layers_merge.out_features
         output_size = self.num_actions if self.discrete_env else len(self.action_low)
         layers = hyperparameters["layers_actor"]
-        self.layers, self.act_functs = create_ff_layers(input_size, layers, output_size)
-        self.act_func_output_layer = self.create_output_act_func()
+        self.layers = create_ff_layers(input_size, layers, output_size)
+        self.script_actor = hyperparameters["script_actor"]
+        # bfloat16 autocast needs CUDA and torch.autocast (torch>=1.10):
+        self.bf16_actor = hyperparameters["bf16_actor"] and torch.device(device).type == "cuda" \
+            and hasattr(torch, "autocast")
+        # If the process group was initialized, e.g. when launched with torchrun, the gradients of the actor layers are
+        # averaged over all ranks:
+        self.distributed = not is_target_net and dist.is_available() and dist.is_initialized()
+        if self.distributed:
+            # DistributedDataParallel can not be scripted:
+            self.script_layers = False
+        self.create_output_act_func()
+        self.core = self.create_core()
         # Put feature extractor on GPU if possible:
         self.to(device)
+        # CUDA graph of the forward pass for acting, captured on first use:
+        self.use_cuda_graph = hyperparameters["actor_cuda_graph"] and hasattr(torch.cuda, "graph")
+        self._infer_graph = None
+        self._graph_input = None
+        self._graph_output = None
+        # With compile_layers the whole SPG target pass across the target nets is compiled as one graph:
+        if self.compile_layers and self.use_SPG:
+            self.spg_target_pass_fn = torch.compile(self.spg_target_pass, mode=self.compile_mode)
+        else:
+            self.spg_target_pass_fn = self.spg_target_pass
 
         # Define optimizer and previous networks
         self.lr = hyperparameters["lr_actor"]
@@ -32,55 +103,109 @@ class Actor(OptimizableNet):
             updateable_parameters = list(self.F_s.get_updateable_params())
         else:
             updateable_parameters = []
-        self.optimizer = self.optimizer(list(self.get_updateable_params()) + updateable_parameters, lr=self.lr)
+        # Target nets are never optimized, so they do not get an optimizer:
+        self.optimizer = self.optimizer(list(self.get_updateable_params()) + updateable_parameters, lr=self.lr) \
+            if not is_target_net else None
 
         if self.use_target_net:
             self.target_net = self.create_target_net()
 
     def forward(self, x):
-        x = apply_layers(x, self.layers, self.act_functs)
-        x = self.act_func_output_layer(x)
-        # print(x)
-        return x
+        if self.bf16_actor:
+            # The backward pass uses the dtypes of the autocast forward pass:
+            with torch.autocast("cuda", dtype=torch.bfloat16):
+                return self.apply_layers(x, self.core)
+        return self.apply_layers(x, self.core)
+
+    def act(self, state_features):
+        """Forward pass for acting, without gradients. If actor_cuda_graph is set, the forward pass is captured in a
+        CUDA graph for the shape of the state features and replayed on the following calls, which skips the Python and
+        kernel launch overhead of every env step."""
+        if not self.use_cuda_graph or state_features.device.type != "cuda" or torch.is_grad_enabled():
+            return self(state_features)
+        if self._infer_graph is None or self._graph_input.shape != state_features.shape \
+                or self._graph_input.dtype != state_features.dtype:
+            self.capture_infer_graph(state_features)
+        self._graph_input.copy_(state_features)
+        self._infer_graph.replay()
+        # The output buffer is overwritten by the next replay:
+        return self._graph_output.clone()
+
+    def capture_infer_graph(self, state_features):
+        self._graph_input = state_features.clone()
+        # Warm up on a side stream before capturing, as required by CUDA graphs:
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self(self._graph_input)
+        torch.cuda.current_stream().wait_stream(stream)
+        self._infer_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._infer_graph):
+            self._graph_output = self(self._graph_input)
+
+    def spg_target_pass(self, state_batch, action_batch):
+        """Q-value advantage of the sampled actions over the actions of the target actor, calculated with the target
+        nets."""
+        # TODO: either convert to max policy using the following line or pass raw output to F_sa and don't one-hot encode
+        state_features_target = self.F_s.target_net(state_batch)
+        actions_target_net = self.target_net(state_features_target)
+        # print("Actions target net: ", actions_target_net)
+        # if self.discrete_env:
+        #    actions_target_net = actions_target_net.argmax(1).unsqueeze(1)
+        state_action_features_sampled_actions = self.Q.F_sa.target_net(state_features_target, action_batch)
+        state_action_features_current_policy = self.Q.F_sa.target_net(state_features_target, actions_target_net,
+                                                                      apply_one_hot_encoding=False)
+        Q_val_sampled_actions = self.Q.target_net(state_action_features_sampled_actions)
+        Q_val_current_policy = self.Q.target_net(state_action_features_current_policy)
+        return Q_val_sampled_actions - Q_val_current_policy
+
+    def create_core(self):
+        """Wrap the layers and the output activations in an ActorCore, which is scripted if script_actor is set.
+        In distributed training the layers are wrapped in DistributedDataParallel instead, which can not be scripted."""
+        layers = self.layers
+        if self.distributed:
+            self.layers.to(self.device)
+            device = torch.device(self.device)
+            if device.type == "cuda":
+                device_ids = [device.index if device.index is not None else torch.cuda.current_device()]
+            else:
+                device_ids = None
+            layers = DistributedDataParallel(self.layers, device_ids=device_ids)
+        core = ActorCore(layers, self.discrete_env, self.relu_idxs, self.sigmoid_idxs, self.tanh_idxs,
+                         self.scaling, self.offset)
+        core.to(self.device)
+        if self.script_actor and not self.distributed:
+            core = torch.jit.script(core)
+        return core
 
     def compute_loss(self, output, target, sample_weights=None):
         # TODO: test if actor training might be better without CrossEntropyLoss. It might be, because we do not need to convert to long!
+        if sample_weights is None and not self.need_sample_losses:
+            # The reduced losses skip the intermediate per-sample loss tensor:
+            if self.use_DDPG:
+                return None, F.l1_loss(output, target)
+            elif self.discrete_env:
+                return None, F.cross_entropy(output, target)
+            else:
+                return None, F.smooth_l1_loss(output, target)
+        if sample_weights is not None:
+            # One weight per sample, broadcast over the action dims:
+            sample_weights = sample_weights.reshape(output.shape[0], 1)
         if self.use_DDPG:
-            loss = abs(target - output)
+            loss = torch.abs(target - output)
         elif self.discrete_env:
-            loss_func = torch.nn.CrossEntropyLoss(reduction='none')
-            loss = loss_func(output, target)
+            loss = F.cross_entropy(output, target, reduction='none')
+            if sample_weights is not None:
+                sample_weights = sample_weights.squeeze(1)
         else:
             # TODO: this loss does not help combat the vanishing gradient problem that we have because of the use of sigmoid activations to squash our actions into the correct range
-            loss = F.smooth_l1_loss(output, target, reduction='none')
+            # The scripted loss computes the loss, the weighting and the mean in one fused pass:
+            return smooth_l1_loss_weighted(output, target, sample_weights)
 
         if sample_weights is not None:
-            loss *= sample_weights.squeeze()
-        return loss.mean()
-
-    def output_function_continuous(self, x):
-        if self.relu_idxs:
-            # x[self.relu_idxs] = F.relu(x[self.relu_idxs])
-            y = F.relu(x[:, self.relu_idxs])
-            with torch.no_grad():
-                x[:, self.relu_idxs] = y
-        if self.sigmoid_idxs:
-            # x[self.sigmoid_idxs] = torch.sigmoid(x[self.sigmoid_idxs])
-            y = x[:, self.sigmoid_idxs].sigmoid()
-            with torch.no_grad():
-                x[:, self.sigmoid_idxs] = y
-        if self.tanh_idxs:
-            # print("first: ", x)
-            # print(self.tanh_idxs)
-            # print(x[:, self.tanh_idxs])
-            y = x[:, self.tanh_idxs].tanh()
-            # x[self.tanh_mask] = torch.tanh(x[self.tanh_mask])
-            # print("after: ", y)
-            with torch.no_grad():
-                x[:, self.tanh_idxs] = y
-            # print("inserted: ", x)
-        #print("Action: ", x)
-        return (x * self.scaling) + self.offset
+            loss = loss * sample_weights
+        return loss, loss.mean()
 
     def create_output_act_func(self):
         print("Action_space: ", self.env.action_space)
@@ -88,41 +213,38 @@ class Actor(OptimizableNet):
         tanh_idxs = []
         sigmoid_idxs = []
 
-        # Init masks:
-        # self.relu_mask = torch.zeros(self.batch_size, len(self.action_low))
-        # self.relu_mask.scatter_(1, torch.tensor(relu_idxs).long(), 1.)
-        # self.tanh_mask = torch.zeros(self.batch_size, len(self.action_low))
-        # self.tanh_mask.scatter_(1, torch.tensor(tanh_idxs).long(), 1.)
-        # self.sigmoid_mask = torch.zeros(self.batch_size, len(self.action_low))
-        # self.sigmoid_mask.scatter_(1, torch.tensor(sigmoid_idxs).long(), 1.)
-
+        # The idxs are turned into device masks by ActorCore:
+        self.scaling = torch.ones(len(self.action_low))
+        self.offset = torch.zeros(len(self.action_low))
         if self.discrete_env:
             print("Actor has only sigmoidal activation function")
             print()
-            return torch.sigmoid
         else:
-            self.scaling = torch.ones(len(self.action_low))
-            self.offset = torch.zeros(len(self.action_low))
-            for i in range(len(self.action_low)):
-                low = self.action_low[i]
-                high = self.action_high[i]
-                if not (low and high):
-                    if low == -math.inf or high == math.inf:
-                        relu_idxs.append(i)
-                        # self.relu_mask[i] = 1.0
-                    else:
-                        sigmoid_idxs.append(i)
-                        # self.sigmoid_mask[i] = 1.0
-                        self.scaling[i] = high + low
-                elif low == high * -1:
-                    if low != -math.inf:
-                        tanh_idxs.append(i)
-                        # self.tanh_mask[i] = 1.0
-                        self.scaling[i] = high
-                else:
-                    self.offset[i] = (high - low) / 2
-                    self.scaling[i] = high - offset[i]
-                    tanh_idxs.append(i)
+            # Classify all action dims at once on the numpy bounds of the action space, which also avoids reading the
+            # device buffers element by element:
+            low = np.asarray(self.env.action_space.low, dtype=np.float64)
+            high = np.asarray(self.env.action_space.high, dtype=np.float64)
+            scaling = np.ones_like(low)
+            offset = np.zeros_like(low)
+            # Bounds with a zero are squashed by a ReLU if the other side is open, else by a sigmoid:
+            has_zero_bound = (low == 0) | (high == 0)
+            relu_mask = has_zero_bound & (np.isneginf(low) | np.isposinf(high))
+            sigmoid_mask = has_zero_bound & ~relu_mask
+            # Finite symmetric bounds are squashed by a tanh, infinite ones stay linear:
+            symmetric_mask = ~has_zero_bound & (low == -high)
+            symmetric_tanh_mask = symmetric_mask & np.isfinite(low)
+            # Other bounds are squashed by a tanh around their center:
+            shifted_tanh_mask = ~has_zero_bound & ~symmetric_mask
+            with np.errstate(invalid="ignore"):
+                scaling[sigmoid_mask] = (high + low)[sigmoid_mask]
+                scaling[symmetric_tanh_mask] = high[symmetric_tanh_mask]
+                offset[shifted_tanh_mask] = ((high + low) / 2)[shifted_tanh_mask]
+                scaling[shifted_tanh_mask] = (high - offset)[shifted_tanh_mask]
+            relu_idxs = np.flatnonzero(relu_mask).tolist()
+            sigmoid_idxs = np.flatnonzero(sigmoid_mask).tolist()
+            tanh_idxs = np.flatnonzero(symmetric_tanh_mask | shifted_tanh_mask).tolist()
+            self.scaling = torch.from_numpy(scaling).float()
+            self.offset = torch.from_numpy(offset).float()
             num_linear_actions = len(self.scaling) - len(tanh_idxs) - len(relu_idxs) - len(sigmoid_idxs)
             print("Actor has ", len(relu_idxs), " ReLU, ", len(tanh_idxs), " tanh, ", len(sigmoid_idxs),
                   " sigmoid, and ", num_linear_actions, " linear actions.")
@@ -134,7 +256,13 @@ class Actor(OptimizableNet):
         self.relu_idxs = relu_idxs
         self.sigmoid_idxs = sigmoid_idxs
 
-        return self.output_function_continuous
+    @staticmethod
+    def masked_sample_weights(pos_TDE_mask, weights):
+        """Turn the float mask of the actions to train on into their sample weights, in place. The weights (a scalar or
+        one per sample) are divided by the fraction of selected actions, so the mean over the batch equals the mean over
+        the selected actions."""
+        selected_fraction = pos_TDE_mask.mean().clamp(min=1 / len(pos_TDE_mask))
+        return pos_TDE_mask.mul_(weights).div_(selected_fraction)
 
     def optimize(self, transitions, policy_name=""):
         # Only for debugging:
@@ -145,30 +273,36 @@ class Actor(OptimizableNet):
         action_batch = transitions["action"]
 
         # TODO: also do it for SPG?
-        if self.discrete_env and self.use_CACLA_V or self.use_CACLA_Q:
-            transformed_action_batch = torch.argmax(action_batch, dim=1)
+        # The class idxs of the one-hot actions are computed once for both CACLA variants:
+        if self.discrete_env and (self.use_CACLA_V or self.use_CACLA_Q):
+            transformed_action_batch = action_batch.argmax(dim=1)
 
         # Calculate current actions for state_batch:
         actions_current_state = self(state_features)
-        better_actions_current_state = actions_current_state.detach().clone()
         # if self.discrete_env:
         #    action_batch = one_hot_encode(action_batch, self.num_actions)
         sample_weights = None
+        train_batch_size = None
 
+        # CACLA and SPG train on the full batch and zero the weights of the actions without a pos TDE, instead of gathering
+        # them with the mask. This keeps the shapes fixed and avoids the sync of a variable-size gather. The weights are
+        # divided by the fraction of selected actions, so the mean is still the mean over the selected actions.
         if self.use_CACLA_V:
-            # Check which actions have a pos TDE
-            pos_TDE_mask = (self.V.TDE < 0).squeeze()
-            output = actions_current_state[pos_TDE_mask]
+            # Check which actions have a pos TDE. The critic keeps its TDE on the CPU for the PER priorities:
+            TDE = self.V.TDE.view(-1).to(actions_current_state.device, non_blocking=True)
+            pos_TDE_mask = (TDE < 0).float()
+            train_batch_size = pos_TDE_mask.sum()
+            output = actions_current_state
 
             if self.discrete_env:
-                target = transformed_action_batch[pos_TDE_mask].view(output.shape[0])
+                target = transformed_action_batch
             else:
-                target = action_batch[pos_TDE_mask]
+                target = action_batch
 
             # TODO: investigate why the multiplication by minus one is necessary for sample weights... seems to be for the V.TDE < 0 check. Using all actions with sample weights = TDE also works, but worse in cartpole
             # TODO: also investigate whether scaling by TDE can be beneficial. Both works at least with V.TDE < 0
-            sample_weights = -1 * torch.ones(target.shape)  # .unsqueeze(1) #
-            # sample_weights = self.V.TDE[pos_TDE_mask].view(output.shape)
+            sample_weights = self.masked_sample_weights(pos_TDE_mask, -1.0)
+            # sample_weights = self.V.TDE.view(-1) * pos_TDE_mask
 
             # print(output)
             # print(target)
@@ -178,17 +312,19 @@ class Actor(OptimizableNet):
         if self.use_CACLA_Q:
             # Calculate mask of pos expected Q minus Q(s, mu(s))
             # action_TDE = self.Q.expectations_next_state - self.Q(state_features, actions_current_state).detach()
-            pos_TDE_mask = (self.Q.TDE < 0).squeeze()
+            TDE = self.Q.TDE.view(-1).to(actions_current_state.device, non_blocking=True)
+            pos_TDE_mask = (TDE < 0).float()
+            train_batch_size = pos_TDE_mask.sum()
 
-            output = actions_current_state[pos_TDE_mask]
+            output = actions_current_state
 
             if self.discrete_env:
-                target = transformed_action_batch[pos_TDE_mask].view(output.shape[0])
+                target = transformed_action_batch
             else:
-                target = action_batch[pos_TDE_mask]
+                target = action_batch
 
-            # sample_weights = -1 * torch.ones(output.shape[0])
-            sample_weights = self.Q.TDE[pos_TDE_mask].view(target.shape[0])
+            # sample_weights = -1 * pos_TDE_mask
+            sample_weights = self.masked_sample_weights(pos_TDE_mask, TDE)
 
         # TODO: implement CACLA+Var
 
@@ -196,18 +332,19 @@ class Actor(OptimizableNet):
         if self.use_DDPG:
             # Dirty and fast way (still does not work yet... :-( )
             q_vals = -self.Q(self.Q.F_sa(state_features, actions_current_state)).mean()
-            self.optimizer.zero_grad()
+            zero_grad(self.optimizer)
             q_vals.backward()
             self.optimizer.step()
             return q_vals.detach()
 
             # 1. calculate derivative of Q towards actions 2. Reinforce towards actions plus gradients
-            actions_current_state_detached = Variable(actions_current_state.detach(), requires_grad=True)
+            actions_current_state_detached = actions_current_state.detach().requires_grad_(True)
             state_action_features_current_policy = self.Q.F_sa(state_features, actions_current_state_detached)
             q_vals = self.Q(state_action_features_current_policy)
             actor_loss = q_vals.mean() * -1
-            actor_loss.backward(retain_graph=True)  # retain necessary? I thnk so
-            gradients = actions_current_state_detached.grad
+            # Only the gradient wrt the actions is needed. autograd.grad does not accumulate into the param grads and
+            # frees the graph right away:
+            gradients, = torch.autograd.grad(actor_loss, [actions_current_state_detached])
             self.log.add("DDPG Action Gradient", gradients.mean(), use_skip=self.log_freq)
 
             # Normalize gradients:
@@ -218,9 +355,9 @@ class Actor(OptimizableNet):
             target = (actions_current_state.detach().clone() + gradients)
 
             # Clip actions
-            target = torch.max(torch.min(target, self.action_high), self.action_low)
+            target = clamp_to_bounds(target, self.action_low, self.action_high)
 
-            # sample_weights = torch.ones(target.shape[0]).unsqueeze(1) / abs(self.Q.TDE)
+            # sample_weights = 1 / self.Q.TDE.abs()
 
             # print(sample_weights)
             # print(output)
@@ -229,29 +366,21 @@ class Actor(OptimizableNet):
         if self.use_SPG:
             # Calculate mask of Q(s,a) minus Q(s, mu(s))
             with torch.no_grad():
-                # TODO: either convert to max policy using the following line or pass raw output to F_sa and don't one-hot encode
-                state_features_target = self.F_s.target_net(state_batch)
-                actions_target_net = self.target_net(state_features_target)
-                # print("Actions target net: ", actions_target_net)
-                # if self.discrete_env:
-                #    actions_current_policy = actions_target_net.argmax(1).unsqueeze(1)
-                state_action_features_sampled_actions = self.Q.F_sa.target_net(state_features_target, action_batch)
-                state_action_features_current_policy = self.Q.F_sa.target_net(state_features_target,
-                                                                              actions_current_policy,
-                                                                              apply_one_hot_encoding=False)
-                Q_val_sampled_actions = self.Q.target_net(state_action_features_sampled_actions)
-                Q_val_current_policy = self.Q.target_net(state_action_features_current_policy)
-                action_TDE = Q_val_sampled_actions - Q_val_current_policy
+                action_TDE = self.spg_target_pass_fn(state_batch, action_batch)
                 # print("action TDE: ", action_TDE)
-            pos_TDE_mask = (action_TDE > 0).squeeze()
+            pos_TDE_mask = (action_TDE > 0).view(-1).float()
+            train_batch_size = pos_TDE_mask.sum()
 
             # better_actions_current_state[pos_TDE_mask] = action_batch[pos_TDE_mask]
 
-            output = actions_current_state[pos_TDE_mask]
+            output = actions_current_state
             # print("Output: ", output)
-            target = action_batch[pos_TDE_mask].view(output.shape[0])
+            if self.discrete_env:
+                target = action_batch.view(output.shape[0])
+            else:
+                target = action_batch
             # print("Target: ", target)
-            sample_weights = action_TDE[pos_TDE_mask]
+            sample_weights = self.masked_sample_weights(pos_TDE_mask, action_TDE.view(-1))
 
             # 1. Get batch_actions and batch_best_actions (implement best_actions everywhere)
             # 2. Calculate eval of current action
@@ -276,7 +405,15 @@ class Actor(OptimizableNet):
         # if not self.discrete_env:
         #    target = target.unsqueeze(1)
 
-        if len(output) > 0:
+        # CACLA and SPG train on the full batch, but the update is still skipped if no action has a pos TDE. An
+        # optimizer step with all-zero gradients would move the weights anyway through the momentum of Adam and the
+        # weight decay. Checking the number of selected actions syncs with the device once per update. In distributed
+        # training it is summed over all ranks first, so that either all ranks or none take part in the all-reduce:
+        num_selected = train_batch_size
+        if num_selected is not None and self.distributed:
+            num_selected = num_selected.clone()
+            dist.all_reduce(num_selected)
+        if num_selected is None or num_selected > 0:
             # Train actor towards better actions (loss = better - current)
             error, loss = self.optimize_net(output, target, self.optimizer, sample_weights=sample_weights)
             if not self.optimize_centrally:
@@ -289,7 +426,9 @@ class Actor(OptimizableNet):
             # print("No Training for Actor...")
 
         if self.use_CACLA_V or self.use_CACLA_Q or self.use_SPG:
-            self.log.add("Actor_actual_train_batch_size", len(output), use_skip=self.log_freq)
+            if train_batch_size is None:
+                train_batch_size = len(output)
+            self.log.add("Actor_actual_train_batch_size", train_batch_size, use_skip=self.log_freq)
 
         return error, loss
 
@@ -314,4 +453,7 @@ class Actor(OptimizableNet):
     def load(self, path):
         loaded_model= torch.load(path + "actor.pth")
         self.layers = loaded_model
+        self.core = self.create_core()
+        # The graph refers to the memory of the old layers:
+        self._infer_graph = None
 
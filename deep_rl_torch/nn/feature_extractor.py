@@ -15,6 +15,10 @@ class ProcessState(OptimizableNet):
         self.vector_layers = hyperparameters["layers_feature_vector"]
         self.matrix_layers = hyperparameters["layers_conv"]
         self.normalize_obs = hyperparameters["normalize_obs"]
+        self.checkpoint_conv = hyperparameters["checkpoint_conv"]
+        # NHWC lets cuDNN pick its tensor core conv kernels. The memory formats exist from torch 1.5 on:
+        self.conv_memory_format = torch.channels_last \
+            if hyperparameters["channels_last"] and hasattr(torch, "channels_last") else None
 
         self.freeze_normalizer = False
 
@@ -30,7 +34,7 @@ class ProcessState(OptimizableNet):
         if self.verbose:
             print("merge in size: ", merge_input_size)
             print("merge layers: ", merge_layers)
-        self.layers_merge, self.act_functs_merge = create_ff_layers(merge_input_size, merge_layers, None)
+        self.layers_merge = create_ff_layers(merge_input_size, merge_layers, None)
 
         # TODO: the following does not work yet, make it work at some point
         # self.log.writer.add_graph(self, input_to_model=[torch.rand(vector_len), None], verbose=True)
@@ -42,26 +46,33 @@ class ProcessState(OptimizableNet):
         if self.target_net is not None:
             for proc_dict, proc_dict_target in zip(self.processing_list, self.target_net.processing_list):
                 proc_dict_target["Normalizer"] = proc_dict["Normalizer"]
+            if not self.target_network_polyak:
+                self.target_net.fuse_conv_bn()
 
     def apply_processing_dict(self, x, proc_dict):
         normalizer = proc_dict["Normalizer"]
-        layers = proc_dict["Layers"]
-        act_functs = proc_dict["Act_Functs"]
+        # The eval-mode target net uses its conv layers with the batchnorms folded in, if there are any:
+        fused = proc_dict.get("Fused") if not self.training else None
+        layers = proc_dict["Layers"] if fused is None else fused
         batch_size = x.shape[0]
         if self.normalize_obs:
             x = normalizer.normalize(x)
+        if proc_dict["Memory_Format"] is not None:
+            x = x.contiguous(memory_format=proc_dict["Memory_Format"])
 
-        x = apply_layers(x, layers, act_functs)
-        return x.view(batch_size, -1)
+        if proc_dict["Checkpoint"] and torch.is_grad_enabled():
+            x = apply_layers_checkpointed(x, layers)
+        else:
+            x = self.apply_layers(x, layers)
+        # reshape instead of view, as a channels-last output is not contiguous in NCHW order:
+        return x.reshape(batch_size, -1)
 
     def apply_processing_list(self, x, proc_list):
         outputs = []
         if isinstance(x, dict):
-            for key, proc_dict in zip(x, proc_list):
-                # For e.g. MineRL we need to extract the obs from the key in-depth:
-                obs = x[key]
-                obs = self.apply_processing_dict(obs, proc_dict)
-                outputs.append(obs)
+            # For e.g. MineRL we need to extract the obs from the key in-depth:
+            for obs, proc_dict in zip(x.values(), proc_list):
+                outputs.append(self.apply_processing_dict(obs, proc_dict))
         # If the obs is simply a torch tensor:
         else:
             x = self.apply_processing_dict(x, proc_list[0])
@@ -82,20 +93,25 @@ class ProcessState(OptimizableNet):
         normalizer = Normalizer(obs.shape, self.device, verbose=self.verbose)
         # Create feedforward layers:
         if obs.ndim == 1:
-            layers_vector, act_functs_vector = create_ff_layers(len(obs), self.vector_layers, None)
+            layers_vector = create_ff_layers(len(obs), self.vector_layers, None)
             layers_vector.to(self.device)
-            output_size = layers_vector[-1].out_features
+            output_size = layers_vector.out_features
             
             # Add to lists:
-            layer_dict = {"Layers": layers_vector, "Act_Functs": act_functs_vector, "Normalizer": normalizer}
+            layer_dict = {"Layers": layers_vector, "Normalizer": normalizer, "Checkpoint": False,
+                          "Memory_Format": None}
         # Create conv layers:
         elif 2 <= obs.ndim <= 3:
             if obs.ndim == 2:
                 obs = obs.unsqueeze(0)
-            layers_matrix, output_size, act_functs_matrix = create_conv_layers(obs.shape, self.matrix_layers)
-            layers_matrix.to(self.device)
+            layers_matrix, output_size = create_conv_layers(obs.shape, self.matrix_layers)
+            if self.conv_memory_format is None:
+                layers_matrix.to(self.device)
+            else:
+                layers_matrix.to(self.device, memory_format=self.conv_memory_format)
             # Add to lists:
-            layer_dict = {"Layers": layers_matrix, "Act_Functs": act_functs_matrix, "Normalizer": normalizer}
+            layer_dict = {"Layers": layers_matrix, "Normalizer": normalizer, "Checkpoint": self.checkpoint_conv,
+                          "Memory_Format": self.conv_memory_format}
         else:
             raise NotImplementedError("Four dimensional input data not yet supported.")
         layer_dict["Name"] = name
@@ -125,15 +141,19 @@ class ProcessState(OptimizableNet):
 
     def forward(self, state):
         x = self.apply_processing_list(state, self.processing_list)
-        x = torch.cat(x, dim=1)
-        x = apply_layers(x, self.layers_merge, self.act_functs_merge)
+        # Concatenating a single tensor would only copy it:
+        x = torch.cat(x, dim=1) if len(x) > 1 else x[0]
+        x = self.apply_layers(x, self.layers_merge)
         return x
 
     def forward_next_state(self, states):
-        if self.use_target_net:
-            return self.target_net(states)
-        else:
-            return self(states)
+        # The next state features are only used for the bootstrapped targets, so no graph is needed:
+        with torch.no_grad():
+            if self.use_target_net:
+                with self.target_autocast():
+                    return self.target_net(states).float()
+            else:
+                return self(states)
 
     def freeze_normalizers(self):
         self.freeze_normalizer = True
@@ -159,6 +179,35 @@ class ProcessState(OptimizableNet):
             if self.normalize_obs and not self.freeze_normalizer:
                 normalizer.observe(state)
 
+    def train(self, mode=True):
+        # The input layers are kept in the processing list instead of being registered as submodules, so they need
+        # to be switched between train and eval mode explicitly:
+        super(ProcessState, self).train(mode)
+        for proc_dict in getattr(self, "processing_list", []):
+            proc_dict["Layers"].train(mode)
+        return self
+
+    def fuse_conv_bn(self):
+        """(Re)build the conv layers with folded batchnorms. Needs to be called again after the weights changed."""
+        for proc_dict in self.processing_list:
+            fused = fuse_conv_bn_layers(proc_dict["Layers"])
+            if fused is not None and proc_dict["Memory_Format"] is not None:
+                fused.to(memory_format=proc_dict["Memory_Format"])
+            old_fused = proc_dict.get("Fused")
+            if fused is not None and old_fused is not None:
+                # Update the existing fused layers in place, so that compiled versions of them stay valid:
+                with torch.no_grad():
+                    for old_tensor, tensor in zip(old_fused.state_dict().values(), fused.state_dict().values()):
+                        old_tensor.copy_(tensor)
+            else:
+                proc_dict["Fused"] = fused
+
+    def after_target_update(self):
+        # Polyak averaging changes the target weights on every step, so refolding would cost about as much as the
+        # batchnorm pass it saves. The batchnorms are only folded for hard updates:
+        if self.target_net is not None and not self.target_network_polyak:
+            self.target_net.fuse_conv_bn()
+
     def log_nn_data(self, name=""):
         for layers in self.processing_list:
             self.log_layer_data(layers["Layers"], "F_s_" + layers["Name"], extra_name=name)
@@ -181,11 +230,13 @@ class ProcessState(OptimizableNet):
             torch.save(layer["Layers"], path + layer["Name"] + ".pth")
 
     def load(self, path):
+        # Copy the loaded weights into the existing layers instead of replacing them, so that the optimizers and the
+        # cached parameter lists keep referring to the parameters that are trained:
         loaded_merge = torch.load(path + "merge.pth")
-        self.layers_merge = loaded_merge
+        self.layers_merge.load_state_dict(loaded_merge.state_dict())
         for layer in self.processing_list:
             loaded_model = torch.load(path + layer["Name"] + ".pth")
-            layer["Layers"] = loaded_model
+            layer["Layers"].load_state_dict(loaded_model.state_dict())
 
 
 class ProcessStateAction(OptimizableNet):
@@ -198,12 +249,12 @@ class ProcessStateAction(OptimizableNet):
         # Create layers:
         # Action Embedding
         layers_action = hyperparameters["layers_action"]
-        self.layers_action, self.act_functs_action = create_ff_layers(self.num_actions, layers_action, None)
+        self.layers_action = create_ff_layers(self.num_actions, layers_action, None)
 
         # State features and Action features concat:
-        input_size = state_features_len + self.layers_action[-1].out_features
+        input_size = state_features_len + self.layers_action.out_features
         layers = hyperparameters["layers_state_action_merge"]
-        self.layers_merge, self.act_functs_merge = create_ff_layers(input_size, layers, None)
+        self.layers_merge = create_ff_layers(input_size, layers, None)
 
         # self.log.writer.add_graph(self, input_to_model=torch.rand(state_features_len), verbose=True)
 
@@ -215,16 +266,17 @@ class ProcessStateAction(OptimizableNet):
     def forward(self, state_features, actions, apply_one_hot_encoding=True):
         # if not self.use_actor_critic and apply_one_hot_encoding:
         #    actions = one_hot_encode(actions, self.num_actions)
-        actions = apply_layers(actions, self.layers_action, self.act_functs_action)
+        actions = self.apply_layers(actions, self.layers_action)
         x = torch.cat((state_features, actions), 1)
-        x = apply_layers(x, self.layers_merge, self.act_functs_merge)
+        x = self.apply_layers(x, self.layers_merge)
         return x
 
     def forward_next_state(self, state_features, action):
-        if self.use_target_net:
-            return self.target_net(state_features, action)
-        else:
-            return self(state_features, action)
+        with torch.no_grad():
+            if self.use_target_net:
+                return self.target_net(state_features, action)
+            else:
+                return self(state_features, action)
 
     def log_nn_data(self, name=""):
         self.log_layer_data(self.layers_action, "F_sa_Action", extra_name=name)
@@ -1,7 +1,22 @@
+from contextlib import nullcontext
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
+from torch.nn.utils import parameters_to_vector
+
+from .nn_utils import calc_gradient_norm, calc_norm, soft_update, hard_update, zero_grad
+
 
-from .nn_utils import calc_gradient_norm, calc_norm, soft_update, hard_update
+@torch.jit.script
+def smooth_l1_loss_weighted(output, target, sample_weights: Optional[torch.Tensor]):
+    """Element-wise smooth L1 loss and its (weighted) mean, scripted so that the element-wise ops are fused."""
+    diff = output - target
+    abs_diff = diff.abs()
+    loss = torch.where(abs_diff < 1.0, 0.5 * diff * diff, abs_diff - 0.5)
+    if sample_weights is None:
+        return loss, loss.mean()
+    return loss, (loss * sample_weights).mean()
 
 
 class OptimizableNet(torch.nn.Module):
@@ -21,15 +36,22 @@ class OptimizableNet(torch.nn.Module):
         self.discrete_env = True if "Discrete" in str(env.action_space) else False
         if self.discrete_env:
             self.num_actions = env.action_space.n
-            self.action_low = torch.zeros(self.num_actions)
-            self.action_high = torch.ones(self.num_actions)
+            action_low = torch.zeros(self.num_actions, device=device)
+            action_high = torch.ones(self.num_actions, device=device)
         else:
             self.num_actions = len(env.action_space.low)
-            self.action_low = torch.tensor(env.action_space.low)
-            self.action_high = torch.tensor(env.action_space.high)
+            # as_tensor avoids the extra copy of torch.tensor, the bounds are moved to the device only once here:
+            action_low = torch.as_tensor(env.action_space.low, dtype=torch.float32, device=device)
+            action_high = torch.as_tensor(env.action_space.high, dtype=torch.float32, device=device)
+        # As buffers the bounds are moved along with the network by .to():
+        self.register_buffer("action_low", action_low)
+        self.register_buffer("action_high", action_high)
 
         # To scale the gradient in optimization:
         self.head_count = 0
+        # Cached parameter lists. Filled on first use, after the layers are created, and reset if modules are added:
+        self._cached_params = None
+        self._updateable_param_list = None
 
         # Load hyperparameters:
         if is_target_net:
@@ -37,10 +59,24 @@ class OptimizableNet(torch.nn.Module):
         else:
             self.use_target_net = hyperparameters["use_target_net"]
         self.retain_graph = False
+        # Evaluate the target network in bfloat16 autocast. Needs CUDA and torch.autocast (torch>=1.10):
+        self.bf16_targets = hyperparameters["bf16_targets"] and torch.device(device).type == "cuda" \
+            and hasattr(torch, "autocast")
         self.optimize_centrally = hyperparameters["optimize_centrally"]
         self.max_norm = hyperparameters["max_norm"]
         self.batch_size = hyperparameters["batch_size"]
         self.optimizer = hyperparameters["optimizer"]
+        # torch.compile only exists from torch 2.0 on, older versions run the layers eagerly:
+        self.compile_layers = hyperparameters["compile_layers"] and hasattr(torch, "compile")
+        self.compile_mode = hyperparameters["compile_mode"]
+        self.script_layers = hyperparameters["script_layers"]
+        self._compiled_layer_fns = {}
+        # Compiling the whole forward pass also fuses across the layer stacks, e.g. the feature concatenation and the
+        # first merge layer. The layer stacks are then not compiled on their own:
+        if hyperparameters["compile_forward"] and hasattr(torch, "compile"):
+            self.forward = torch.compile(self.forward, mode=self.compile_mode)
+            self.compile_layers = False
+            self.script_layers = False
         # Actor:
         self.use_actor_critic = hyperparameters["use_actor_critic"]
         self.use_CACLA_V = hyperparameters["use_CACLA_V"]
@@ -48,28 +84,48 @@ class OptimizableNet(torch.nn.Module):
         self.use_DDPG = hyperparameters["use_DDPG"]
         self.use_SPG = hyperparameters["use_SPG"]
         self.use_GISPG = hyperparameters["use_GISPG"]
+        # The per-sample losses are only needed for PER priorities and the TDE-based actor updates:
+        self.need_sample_losses = hyperparameters["use_PER"] or self.use_actor_critic
 
         # Target net:
         self.target_network_polyak = hyperparameters["use_polyak_averaging"]
         if self.target_network_polyak:
             self.tau = hyperparameters["polyak_averaging_tau"]
         self.target_network_hard_steps = hyperparameters["target_network_hard_steps"]
+        # The update type is fixed, so pick the update method once instead of branching on every call:
+        if self.target_network_polyak:
+            self._target_update_fn = self._soft_update_targets
+        else:
+            self._target_update_fn = self._hard_update_targets
 
     def compute_loss(self, output, target, sample_weights):
-        loss = F.smooth_l1_loss(output, target, reduction='none')
-        if sample_weights is None:
-            reduced_loss = loss.mean()
-        else:
-            reduced_loss = (loss * sample_weights).mean()
-        return loss, reduced_loss
+        if not self.need_sample_losses and sample_weights is None:
+            return None, F.smooth_l1_loss(output, target)
+        return smooth_l1_loss_weighted(output, target, sample_weights)
+
+    def apply_layers(self, x, layers):
+        """Apply the nn.Sequential layers to x. If compile_layers or script_layers is set, every layer stack is compiled
+        with torch.compile (in the compile_mode) or with TorchScript once on its first use. Both share the parameters
+        with the layers, so in-place updates of the weights are seen by the compiled stacks."""
+        if not (self.compile_layers or self.script_layers):
+            return layers(x)
+        try:
+            layer_fn = self._compiled_layer_fns[layers]
+        except KeyError:
+            if self.compile_layers:
+                layer_fn = torch.compile(layers, mode=self.compile_mode)
+            else:
+                layer_fn = torch.jit.script(layers)
+            self._compiled_layer_fns[layers] = layer_fn
+        return layer_fn(x)
 
     def optimize_net(self, output, target, optimizer, name="", sample_weights=None, retain_graph=False):
         """Start loss calculation and optimize parameters if they are not optimized centrally"""
         loss, reduced_loss = self.compute_loss(output, target, sample_weights)
 
         if not self.optimize_centrally:
-            optimizer.zero_grad()
-            reduced_loss.backward(retain_graph=self.retain_graph + retain_graph)
+            zero_grad(optimizer)
+            reduced_loss.backward(retain_graph=self.retain_graph or retain_graph)
             self.scale_gradient()
             self.norm_gradient()
             optimizer.step()
@@ -77,10 +133,15 @@ class OptimizableNet(torch.nn.Module):
             self.log_nn_data()
 
         name = "losses/loss_" + self.name + (("_" + name) if name != "" else "")
-        detached_loss = reduced_loss.detach().clone().item()
-        self.log.add(name, detached_loss, use_skip=True)
+        # The log keeps a running mean of the detached loss tensor, so the device is only synchronized when the mean is
+        # actually written out instead of on every step:
+        self.log.add(name, reduced_loss.detach(), use_skip=True)
 
-        PER_weights = loss.detach().clone().cpu()
+        if loss is None:
+            PER_weights = 0
+        else:
+            # .cpu() already returns a new tensor for GPU tensors, a clone is not needed:
+            PER_weights = loss.detach().cpu()
 
         # Increment counter in the feature extractors to scale their gradients later on:
         if self.F_s is not None:
@@ -90,24 +151,69 @@ class OptimizableNet(torch.nn.Module):
 
         return PER_weights, reduced_loss
 
+    def __setattr__(self, name, value):
+        if isinstance(value, (torch.nn.Module, torch.nn.Parameter)):
+            self._invalidate_param_cache()
+        super(OptimizableNet, self).__setattr__(name, value)
+
+    def add_module(self, name, module):
+        self._invalidate_param_cache()
+        super(OptimizableNet, self).add_module(name, module)
+
+    def _invalidate_param_cache(self):
+        # Written to __dict__ directly, as this can be called before torch.nn.Module.__init__ has run:
+        self.__dict__["_cached_params"] = None
+        self.__dict__["_updateable_param_list"] = None
+
+    def get_params(self):
+        """Return a cached list of all parameters, to avoid traversing the module tree on every call."""
+        if self._cached_params is None:
+            self._cached_params = list(self.parameters())
+        return self._cached_params
+
     def get_updateable_params(self):
-        return self.parameters()
+        return self.get_params()
+
+    def get_updateable_param_list(self):
+        """Return a cached list of the updateable parameters."""
+        if self._updateable_param_list is None:
+            self._updateable_param_list = list(self.get_updateable_params())
+        return self._updateable_param_list
+
+    def target_autocast(self):
+        """Context for evaluating the target network. Its outputs are only used as bootstrapping targets, so bfloat16
+        matmuls are precise enough. The fp32 weights are kept, so the target updates are not affected."""
+        if self.bf16_targets:
+            return torch.autocast("cuda", dtype=torch.bfloat16)
+        return nullcontext()
 
     def update_targets(self, steps):
-        """Update weights of the target networks."""
-        if self.target_network_polyak:
-            soft_update(self, self.target_net, self.tau)
-        else:
-            if steps % self.target_network_hard_steps == 0:
-                hard_update(self, self.target_net)
+        """Update weights of the target networks with the update method picked in __init__."""
+        self._target_update_fn(steps)
+
+    def _soft_update_targets(self, steps):
+        soft_update(self, self.target_net, self.tau)
+        self.after_target_update()
+
+    def _hard_update_targets(self, steps):
+        if steps % self.target_network_hard_steps == 0:
+            hard_update(self, self.target_net)
+            self.after_target_update()
+
+    def after_target_update(self):
+        """Called after the weights of the target network were changed."""
+        pass
 
     def create_target_net(self):
         """Create a target network of itself with frozen weights"""
         target_net = None
         if self.use_target_net:
             target_net = self.recreate_self()
-            for param in target_net.parameters():
+            # The updateable params can include layers that are not registered as submodules:
+            for param in target_net.get_params() + list(target_net.get_updateable_param_list()):
                 param.requires_grad = False
+            # Start from the current weights instead of the fresh initialization of the recreated net:
+            hard_update(self, target_net)
             target_net.use_target_net = False
             target_net.eval()
         return target_net
@@ -122,23 +228,32 @@ class OptimizableNet(torch.nn.Module):
             self.log.add("Grad Norm/" + name, grad_norm)
             name += "_" + extra_name + "_" if extra_name else ""
 
+            # The flattened weights and gradients are only built if the histograms are actually logged:
             if self.log.is_available("NN_distributions", skip_steps=5):
-                weights = torch.cat([torch.flatten(layer).detach() for layer in layers.parameters()])\
-                    .view(-1)
-                gradients = torch.cat([torch.flatten(layer.grad.data).detach() for layer in layers.parameters()])\
-                    .view(-1)
+                params = list(layers.parameters())
+                weights = parameters_to_vector([param.detach() for param in params])
                 self.log.add("Weights/" + name, weights, distribution=True)
-                self.log.add("Gradients/" + name, gradients, distribution=True)
+                grads = [param.grad.detach() for param in params if param.grad is not None]
+                if grads:
+                    gradients = parameters_to_vector(grads)
+                    self.log.add("Gradients/" + name, gradients, distribution=True)
 
     def norm_gradient(self):
         if self.max_norm:
-            torch.nn.utils.clip_grad.clip_grad_norm_(self.parameters(), self.max_norm)
+            torch.nn.utils.clip_grad.clip_grad_norm_(self.get_params(), self.max_norm)
 
-    def scale_gradient(self):
-        """Scales the gradient of this network based on how many networks let their gradients flow into it"""
-        params = self.get_updateable_params()
-        for layer in params:
-            layer.grad.data = layer.grad.data / self.head_count
+    def scale_gradient(self, accumulation_steps=1):
+        """Scales the gradient of this network based on how many networks let their gradients flow into it.
+        If gradients of several batches were accumulated, the heads were counted once per batch."""
+        grads = [param.grad for param in self.get_updateable_param_list() if param.grad is not None]
+        if grads:
+            num_heads = self.head_count / accumulation_steps
+            # Divide all gradients in place with one multi-tensor kernel if this torch version has it:
+            if hasattr(torch, "_foreach_div_"):
+                torch._foreach_div_(grads, float(num_heads))
+            else:
+                for grad in grads:
+                    grad.div_(num_heads)
         # Reset head count:
         self.head_count = 0
 
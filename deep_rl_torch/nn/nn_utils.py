@@ -1,29 +1,83 @@
+import inspect
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
+
+# Newer torch versions can checkpoint without the reentrant autograd function, which also works for inputs that do
+# not require gradients:
+_CHECKPOINT_NON_REENTRANT = "use_reentrant" in inspect.signature(checkpoint).parameters
 
 
 def conv2d_size_out(size, kernel_size=5, stride=2):
     return (size - (kernel_size - 1) - 1) // stride + 1
 
 
-def act_funct_string2function(name):
+def act_funct_string2module(name):
     name = name.lower()
     if name == "relu":
-        return F.relu
+        return nn.ReLU()
     elif name == "sigmoid":
-        return torch.sigmoid
+        return nn.Sigmoid()
     elif name == "tanh":
-        return torch.tanh
-
-
-def query_act_funct(layer_dict):
-    try:
-        activation_function = act_funct_string2function(layer_dict["act_func"])
-    except KeyError:
-        def activation_function(x):
-            return x
-    return activation_function
+        return nn.Tanh()
+
+
+def append_act_module(modules, layer_dict):
+    """Append the activation function of the layer as a module to the list, if it has one."""
+    if "act_func" in layer_dict:
+        act_module = act_funct_string2module(layer_dict["act_func"])
+        if act_module is not None:
+            modules.append(act_module)
+
+
+@torch.jit.script
+def lstm_zero_state_output(gates, bias_hh):
+    """Hidden output of an LSTM step from a zero state. The forget gate drops out, as the previous cell is zero."""
+    gates = gates + bias_hh
+    # split instead of chunk, as the TorchScript gradient of chunk fails if one of its outputs is unused:
+    input_gate, _, cell_gate, output_gate = gates.split(gates.size(1) // 4, 1)
+    cell = torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+    return torch.sigmoid(output_gate) * torch.tanh(cell)
+
+
+@torch.jit.script
+def gru_zero_state_output(gates, bias_hh):
+    """Hidden output of a GRU step from a zero state."""
+    x_r, x_z, x_n = gates.chunk(3, 1)
+    b_r, b_z, b_n = bias_hh.chunk(3, 0)
+    reset_gate = torch.sigmoid(x_r + b_r)
+    update_gate = torch.sigmoid(x_z + b_z)
+    new_gate = torch.tanh(x_n + reset_gate * b_n)
+    return (1 - update_gate) * new_gate
+
+
+class SingleStepRNN(nn.Module):
+    """An LSTM or GRU layer for a batch of feature vectors, i.e. a sequence of length one from a zero hidden state.
+    The hidden-to-hidden matmul drops out for a zero state, so a step is one matmul plus fused pointwise gate ops
+    instead of a full cuDNN RNN call."""
+    def __init__(self, input_size, hidden_size, cell_type):
+        super(SingleStepRNN, self).__init__()
+        self.cell_type = cell_type
+        self.in_features = input_size
+        self.out_features = hidden_size
+        num_gates = 4 if cell_type == "lstm" else 3
+        self.weight_ih = nn.Parameter(torch.empty(num_gates * hidden_size, input_size))
+        self.bias_ih = nn.Parameter(torch.empty(num_gates * hidden_size))
+        self.bias_hh = nn.Parameter(torch.empty(num_gates * hidden_size))
+        # Same initialization as nn.LSTM and nn.GRU:
+        bound = 1.0 / math.sqrt(hidden_size)
+        for param in self.parameters():
+            nn.init.uniform_(param, -bound, bound)
+
+    def forward(self, x):
+        if self.cell_type == "lstm":
+            return lstm_zero_state_output(F.linear(x, self.weight_ih, self.bias_ih), self.bias_hh)
+        else:
+            return gru_zero_state_output(F.linear(x, self.weight_ih, self.bias_ih), self.bias_hh)
 
 
 def string2layer(name, input_size, neurons):
@@ -31,26 +85,29 @@ def string2layer(name, input_size, neurons):
     if name == "linear":
         return nn.Linear(input_size, neurons)
     elif name == "lstm":
-        return nn.LSTM(input_size, neurons)
+        return SingleStepRNN(input_size, neurons, "lstm")
     elif name == "gru":
-        return nn.GRU(input_size, neurons)
+        return SingleStepRNN(input_size, neurons, "gru")
 
 
 def create_ff_layers(input_size, layer_dict, output_size):
-    layers = nn.ModuleList()
-    act_functs = []
+    """Create an nn.Sequential of the layers and their activation functions. Its out_features attribute holds the
+    size of its output."""
+    modules = []
     for layer in layer_dict:
         this_layer_neurons = layer["neurons"]
-        layers.append(string2layer(layer["name"], input_size, this_layer_neurons))
-        act_functs.append(query_act_funct(layer))
+        modules.append(string2layer(layer["name"], input_size, this_layer_neurons))
+        append_act_module(modules, layer)
         input_size = this_layer_neurons
     if output_size is not None:
-        layers.append(nn.Linear(input_size, output_size))
-        act_functs.append(None)
-    return layers, act_functs
+        modules.append(nn.Linear(input_size, output_size))
+        input_size = output_size
+    layers = nn.Sequential(*modules)
+    layers.out_features = input_size
+    return layers
 
 
-# Create a module list of conv layers specified in layer_dict
+# Create an nn.Sequential of conv layers specified in layer_dict
 def create_conv_layers(input_matrix_shape, layer_dict):
     # format for entry in matrix_layers: ("conv", channels_in, channels_out, kernel_size, stride) if conv or
     #  ("batchnorm") for batchnorm
@@ -59,43 +116,104 @@ def create_conv_layers(input_matrix_shape, layer_dict):
     matrix_width = input_matrix_shape[1]
     matrix_height = input_matrix_shape[2]
 
-    act_functs = []
-    layers = nn.ModuleList()
-    for layer in layer_dict:
+    modules = []
+    for idx, layer in enumerate(layer_dict):
         # Layer:
         if layer["name"] == "batchnorm":
-            layers.append(nn.BatchNorm2d(channel_last_layer))
+            modules.append(nn.BatchNorm2d(channel_last_layer))
         elif layer["name"] == "conv":
             this_layer_channels = layer["filters"]
-            layers.append(nn.Conv2d(channel_last_layer, this_layer_channels, layer["kernel_size"],
-                                    layer["stride"]))
-            matrix_width = conv2d_size_out(matrix_width, layer["kernel_size"], layer["stride"])
-            matrix_height = conv2d_size_out(matrix_height, layer["kernel_size"], layer["stride"])
+            kernel_size = layer["kernel_size"]
+            stride = layer["stride"]
+            # The bias of a conv that is directly followed by a batchnorm is cancelled by its mean subtraction:
+            followed_by_bn = act_funct_string2module(layer.get("act_func", "")) is None and idx + 1 < len(layer_dict) \
+                and layer_dict[idx + 1]["name"] == "batchnorm"
+            modules.append(nn.Conv2d(channel_last_layer, this_layer_channels, kernel_size, stride,
+                                     bias=not followed_by_bn))
+            matrix_width = conv2d_size_out(matrix_width, kernel_size, stride)
+            matrix_height = conv2d_size_out(matrix_height, kernel_size, stride)
             channel_last_layer = this_layer_channels
 
-        act_functs.append(query_act_funct(layer))
+        append_act_module(modules, layer)
 
     conv_output_size = matrix_width * matrix_height * channel_last_layer
-    return layers, conv_output_size, act_functs
-
-
-def apply_layers(x, layers, act_functs):
-    for idx in range(len(layers)):
-        layer = layers[idx]
-        act_func = act_functs[idx]
-        x = layer(x)
-        if act_functs[idx] is not None:
-            x = act_func(x)
-    return x
+    layers = nn.Sequential(*modules)
+    layers.out_features = conv_output_size
+    return layers, conv_output_size
+
+
+def fuse_conv_bn_layers(layers):
+    """Fold every BatchNorm2d that directly follows a Conv2d (i.e. a conv without activation function) into the conv,
+    which saves one pass over the feature map. The layers must be in eval mode. Returns the new nn.Sequential, or None
+    if there is nothing to fuse."""
+    fused_modules = []
+    fused_any = False
+    idx = 0
+    with torch.no_grad():
+        while idx < len(layers):
+            layer = layers[idx]
+            if isinstance(layer, nn.Conv2d) and idx + 1 < len(layers) and isinstance(layers[idx + 1], nn.BatchNorm2d):
+                layer = fuse_conv_bn_eval(layer, layers[idx + 1])
+                fused_any = True
+                idx += 1
+            fused_modules.append(layer)
+            idx += 1
+    if not fused_any:
+        return None
+    return nn.Sequential(*fused_modules)
+
+
+def apply_layers_checkpointed(x, layers):
+    """Apply the nn.Sequential layers split into about sqrt(n) segments, of which only the inputs are kept for the
+    backward pass. The activations within a segment are recomputed during backward, which saves activation memory at
+    the cost of a second forward pass.
+    Batchnorm layers are applied outside of the segments, as recomputing them in train mode would update their running
+    statistics a second time. Their inputs are therefore stored like without checkpointing, which saves less memory for
+    conv archs with batchnorms."""
+    num_layers = len(layers)
+    segment_len = math.ceil(num_layers / max(int(math.sqrt(num_layers)), 1))
+    segment = []
+    for layer in layers:
+        if isinstance(layer, nn.modules.batchnorm._BatchNorm):
+            x = apply_segment_checkpointed(x, segment)
+            segment = []
+            x = layer(x)
+            continue
+        segment.append(layer)
+        if len(segment) == segment_len:
+            x = apply_segment_checkpointed(x, segment)
+            segment = []
+    return apply_segment_checkpointed(x, segment)
+
+
+def apply_segment_checkpointed(x, segment):
+    if not segment:
+        return x
+    segment = nn.Sequential(*segment)
+    if _CHECKPOINT_NON_REENTRANT:
+        return checkpoint(segment, x, use_reentrant=False)
+    elif x.requires_grad:
+        return checkpoint(segment, x)
+    # The reentrant checkpoint does not compute parameter gradients if its input does not require a gradient:
+    return segment(x)
+
+
+def clamp_to_bounds(x, low, high):
+    """Clamp x to the per-dim bounds in one kernel. Tensor bounds for torch.clamp need torch>=1.9, older versions
+    take the min and max."""
+    try:
+        return torch.clamp(x, low, high)
+    except TypeError:
+        return torch.max(torch.min(x, high), low)
 
 
 def one_hot_encode(x, num_actions):
-    y = torch.zeros(x.shape[0], num_actions).float()
-    return y.scatter(1, x, 1)
+    """One-hot encode a (N, 1) tensor of action idxs into a float (N, num_actions) tensor on the device of x."""
+    return F.one_hot(x.squeeze(-1).long(), num_classes=num_actions).float()
 
 
 def calc_gradient_norm(layers):
-    grads = [p.grad.data for p in layers.parameters()]
+    grads = [p.grad.data for p in layers.parameters() if p.grad is not None]
     return calc_list_norm(grads)
     # total_norm = 0
     # for p in layers.parameters():
@@ -115,10 +233,12 @@ def calc_norm(layers):
 
 
 def calc_list_norm(layer_list):
-    total_norm = torch.tensor(0.)
-    for param in layer_list:
-        total_norm += torch.norm(param)
-    return total_norm.item()
+    # Sum the norms on the device of the params, so that only the final .item() syncs instead of every addition to a
+    # CPU tensor:
+    norms = [torch.norm(param.detach()) for param in layer_list]
+    if not norms:
+        return 0.
+    return torch.stack(norms).sum().item()
 
 
 def calc_list_norm_std(layer_list):
@@ -134,14 +254,39 @@ def calc_list_norm_std(layer_list):
     return torch.sqrt(total_norm), torch.std(torch.tensor(all_norms))
 
 
+def zero_grad(optimizer):
+    """Reset the gradients to None instead of writing zeros into them, if the torch version supports it."""
+    try:
+        optimizer.zero_grad(set_to_none=True)
+    except TypeError:
+        optimizer.zero_grad()
+
+
 def soft_update(net, net_target, tau):
-    for param_target, param in zip(net_target.get_updateable_params(), net.get_updateable_params()):
-        param_target.data.copy_(param_target.data * (1.0 - tau) + param.data * tau)
+    params_target = net_target.get_updateable_param_list()
+    params = net.get_updateable_param_list()
+    with torch.no_grad():
+        # Update all parameters with multi-tensor kernels if this torch version has them. The lerp does the polyak
+        # average in one pass instead of a mul and an add:
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(params_target, params, tau)
+        elif hasattr(torch, "_foreach_mul_"):
+            torch._foreach_mul_(params_target, 1.0 - tau)
+            torch._foreach_add_(params_target, params, alpha=tau)
+        else:
+            for param_target, param in zip(params_target, params):
+                param_target.mul_(1.0 - tau).add_(param, alpha=tau)
 
 
 def hard_update(net, net_target):
-    for param_target, param in zip(net_target.get_updateable_params(), net.get_updateable_params()):
-        param_target.data.copy_(param.data)
+    params_target = net_target.get_updateable_param_list()
+    params = net.get_updateable_param_list()
+    with torch.no_grad():
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(params_target, params)
+        else:
+            for param_target, param in zip(params_target, params):
+                param_target.copy_(param)
 
 
 def count_parameters(param_list):
@@ -8,27 +8,32 @@ class Normalizer():
         self.mean = torch.zeros(input_shape, device=device)
         self.mean_diff = torch.zeros(input_shape, device=device)
         self.var = torch.ones(input_shape, device=device)
+        # The std is updated along with the var in observe, so normalize does not need to take the sqrt on every call:
+        self.std = torch.ones(input_shape, device=device)
 
 
     def observe(self, x):
         x = x.float().detach()
         self.n += 1.
-        last_mean = self.mean.clone()
         assert self.mean.shape == x.shape[1:], "Mean and Input have different shapes. Mean shape: " + str(self.mean.shape) + " X shape: " + str(x.shape)
-        self.mean += (x - self.mean).mean(dim=0) / self.n
-        self.mean_diff += (x - last_mean).mean(dim=0) * (x - self.mean).mean(dim=0)
-        self.var = torch.clamp(self.mean_diff / self.n, min=1e-2)
+        # (x - mean).mean(dim=0) equals x.mean(dim=0) - mean, so the batch is only reduced once. The statistics are
+        # updated in place on the device, without a sync:
+        batch_mean = x.mean(dim=0)
+        last_mean_diff = batch_mean - self.mean
+        self.mean.add_(last_mean_diff, alpha=1. / self.n)
+        self.mean_diff.addcmul_(last_mean_diff, batch_mean - self.mean)
+        torch.clamp(self.mean_diff / self.n, min=1e-2, out=self.var)
+        torch.sqrt(self.var, out=self.std)
 
     def normalize(self, inputs):
-        obs_std = torch.sqrt(self.var)
         assert inputs.dtype == torch.float16 or inputs.dtype == torch.float32 or inputs.dtype == torch.float64
-        return (inputs - self.mean) / obs_std
+        return (inputs - self.mean) / self.std
 
     def denormalize(self, inputs):
-        obs_std = torch.sqrt(self.var)
-        return (inputs.float() * obs_std) + self.mean
+        return (inputs.float() * self.std) + self.mean
 
     def to(self, device):
-        self.mean.to(device)
-        self.mean_diff.to(device)
-        self.var.to(device)
+        self.mean = self.mean.to(device)
+        self.mean_diff = self.mean_diff.to(device)
+        self.var = self.var.to(device)
+        self.std = self.std.to(device)
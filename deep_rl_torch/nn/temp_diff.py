@@ -1,4 +1,5 @@
 import os
+from contextlib import nullcontext
 
 import torch
 from .networks import OptimizableNet
@@ -15,6 +16,8 @@ class TempDiffNet(OptimizableNet):
         self.dtype = torch.half if hyperparameters["use_half"] else torch.float
 
         self.current_reward_prediction = None
+        # Reused output of calculate_next_state_values, reallocated only if the batch size changes:
+        self._next_state_values_buf = None
 
         # Eligibility traces:
         self.use_efficient_traces = hyperparameters["use_efficient_traces"]
@@ -25,10 +28,10 @@ class TempDiffNet(OptimizableNet):
     def create_split_net(self, input_size, updateable_parameters, device, hyperparameters):
         lr_r = hyperparameters["lr_r"]
         reward_layers = hyperparameters["layers_r"]
-        layers_r, act_functs_r = create_ff_layers(input_size, reward_layers, self.output_neurons)
+        layers_r = create_ff_layers(input_size, reward_layers, self.output_neurons)
         layers_r.to(device)
         optimizer_r = self.optimizer(list(layers_r.parameters()) + updateable_parameters, lr=lr_r)
-        return layers_r, act_functs_r, optimizer_r
+        return layers_r, optimizer_r
 
 
     def recreate_self(self):
@@ -41,25 +44,31 @@ class TempDiffNet(OptimizableNet):
     def forward(self, x):
         predicted_reward = 0
         if self.split:
-            predicted_reward = apply_layers(x, self.layers_r, self.act_functs_r)
-        predicted_state_value = apply_layers(x, self.layers_TD, self.act_functs_TD)
+            predicted_reward = self.apply_layers(x, self.layers_r)
+        predicted_state_value = self.apply_layers(x, self.layers_TD)
         return predicted_state_value + predicted_reward
 
     def forward_r(self, x):
-        return apply_layers(x, self.layers_r, self.act_functs_r)
+        return self.apply_layers(x, self.layers_r)
 
     def forward_R(self, x):
-        return apply_layers(x, self.layers_TD, self.act_functs_TD)
+        return self.apply_layers(x, self.layers_TD)
 
     def calculate_next_state_values(self, non_final_next_state_features, non_final_mask, actor=None, use_target_net=True):
-        next_state_values = torch.zeros(len(non_final_mask), 1, device=self.device, dtype=self.dtype)
+        next_state_values = self._next_state_values_buf
+        if next_state_values is None or next_state_values.shape[0] != len(non_final_mask):
+            next_state_values = torch.zeros(len(non_final_mask), 1, device=self.device, dtype=self.dtype)
+            self._next_state_values_buf = next_state_values
+        else:
+            next_state_values.zero_()
         if non_final_next_state_features is None:
             return next_state_values
-        with torch.no_grad():
-            predict_net = self.target_net if use_target_net else self
+        predict_net = self.target_net if use_target_net else self
+        with torch.no_grad(), (self.target_autocast() if use_target_net else nullcontext()):
             next_state_predictions = predict_net.predict_state_value(non_final_next_state_features, self.F_sa,
-                                                                         actor)
-        next_state_values[non_final_mask] = next_state_predictions
+                                                                     actor)
+        mask = torch.as_tensor(non_final_mask, dtype=torch.bool).to(self.device, non_blocking=True).unsqueeze(1)
+        next_state_values.masked_scatter_(mask, next_state_predictions.to(next_state_values.dtype))
         return next_state_values
 
     def calculate_updated_value_next_state(self, reward_batch, non_final_next_state_features, non_final_mask,
@@ -72,7 +81,12 @@ class TempDiffNet(OptimizableNet):
         # print("Prediction next state: ", predictions_next_state)
 
         # Compute the updated expected values. Do not add the reward, if the critic is split
-        return (reward_batch if not self.split else 0) + (self.predictions_next_state * self.gamma)
+        if self.split:
+            return self.predictions_next_state * self.gamma
+        if torch.is_tensor(reward_batch):
+            # The discounting and the reward addition in one kernel:
+            return torch.add(reward_batch, self.predictions_next_state, alpha=self.gamma)
+        return reward_batch + self.predictions_next_state * self.gamma
 
     def update_traces(self, episode_transitions, lambda_val, actor=None, V=None, Q=None, last_trace_value=None):
         num_steps_in_episode = len(episode_transitions["states"])
@@ -242,19 +256,19 @@ class Q(TempDiffNet):
 
         # Create split net:
         if self.split and not is_target_net:
-            self.layers_r, self.act_functs_r, self.optimizer_r = self.create_split_net(self.input_size,
-                                                                                       updateable_parameters,
-                                                                                       device, hyperparameters)
+            self.layers_r, self.optimizer_r = self.create_split_net(self.input_size,
+                                                                    updateable_parameters,
+                                                                    device, hyperparameters)
             #print("RRRRRR:")
             #print(list(self.layers_r.state_dict().keys()) + list(F_s.get_updateable_params()))
             #print(type(next(self.layers_r.parameters())))
         else:
-            self.layers_r, self.act_functs_r, self.optimizer_r = None, None, None
+            self.layers_r, self.optimizer_r = None, None
 
 
             # Create layers
         layers = hyperparameters["layers_Q"]
-        self.layers_TD, self.act_functs_TD = create_ff_layers(self.input_size, layers, self.output_neurons)
+        self.layers_TD = create_ff_layers(self.input_size, layers, self.output_neurons)
         # Put feature extractor on GPU if possible:
         self.layers_TD.to(device)
 
@@ -271,12 +285,13 @@ class Q(TempDiffNet):
         #    print("TD::::")
         #    print(list(self.layers_TD.state_dict().keys()) + list(F_s.state_dict().keys()))
 
-        self.optimizer_TD = self.optimizer(list(self.layers_TD.parameters()) + updateable_parameters, lr=self.lr_TD)
+        # Target nets are never optimized, so they do not get an optimizer:
+        self.optimizer_TD = self.optimizer(list(self.layers_TD.parameters()) + updateable_parameters, lr=self.lr_TD) \
+            if not is_target_net else None
         # Create target net
         self.target_net = self.create_target_net()
         if self.target_net and self.split:
             self.target_net.layers_r = self.layers_r
-            self.target_net.act_functs_r = self.act_functs_r
 
 
     def predict_next_state(self, non_final_next_state_features, non_final_mask, actor=None, Q=None, V=None, use_target_net=True):
@@ -347,7 +362,7 @@ class V(TempDiffNet):
 
         # Create layers
         layers = hyperparameters["layers_V"]
-        self.layers_TD, self.act_functs_TD = create_ff_layers(input_size, layers, self.output_neurons)
+        self.layers_TD = create_ff_layers(input_size, layers, self.output_neurons)
         # Put feature extractor on GPU if possible:
         self.to(device)
 
@@ -360,22 +375,23 @@ class V(TempDiffNet):
 
         # Create split net:
         if self.split and not is_target_net:
-            self.layers_r, self.act_functs_r, self.optimizer_r = self.create_split_net(self.input_size,
-                                                                                       updateable_parameters,
-                                                                                       device, hyperparameters)
+            self.layers_r, self.optimizer_r = self.create_split_net(self.input_size,
+                                                                    updateable_parameters,
+                                                                    device, hyperparameters)
         else:
-            self.layers_r, self.act_functs_r, self.optimizer_r = None, None, None
+            self.layers_r, self.optimizer_r = None, None
 
         # Define optimizer and previous networks
         self.lr_TD = hyperparameters["lr_V"]
         self.F_s = F_s
-        self.optimizer_TD = self.optimizer(list(self.layers_TD.parameters()) + updateable_parameters, lr=self.lr_TD)
+        # Target nets are never optimized, so they do not get an optimizer:
+        self.optimizer_TD = self.optimizer(list(self.layers_TD.parameters()) + updateable_parameters, lr=self.lr_TD) \
+            if not is_target_net else None
 
         # Create target net
         self.target_net = self.create_target_net()
         if self.target_net and self.split:
             self.target_net.layers_r = self.layers_r
-            self.target_net.act_functs_r = self.act_functs_r
 
 
     def predict_next_state(self, non_final_next_states, non_final_mask, actor=None, Q=None, V=None, use_target_net=True):
@@ -29,6 +29,8 @@ def create_parser():
     parser.add_argument("--store_stacked", type=int, help="Store a stacked state after its individual frames have been"
                                                           " stacked. This can increase speed, but costs memory space. ",
                         default=0)
+    parser.add_argument("--frame_pool_dir", help="Directory (e.g. /dev/shm) in which the stacked frames are stored as a"
+                                                 " memory-mapped file. If empty, they are kept in RAM.", default="")
     parser.add_argument("--max_episode_steps", type=int, help="Limit the length of episodes", default=0)
     parser.add_argument("--reward_std", type=float, default=0.0)
     # Target net:
@@ -82,6 +84,25 @@ def create_parser():
     # NN Training:
     parser.add_argument("--optimize_centrally", type=int, default=1)
     parser.add_argument("--use_half", type=int, default=0)
+    parser.add_argument("--channels_last", type=int, help="Store the conv weights and inputs in NHWC memory format",
+                        default=0)
+    parser.add_argument("--checkpoint_conv", type=int, help="Recompute the conv activations during the backward pass"
+                        " instead of storing them, to save GPU memory", default=0)
+    parser.add_argument("--bf16_targets", type=int, help="Evaluate the target networks in bfloat16 autocast (CUDA)",
+                        default=0)
+    parser.add_argument("--bf16_actor", type=int, help="Run the actor forward and backward pass in bfloat16 autocast"
+                        " (CUDA)", default=0)
+    parser.add_argument("--compile_layers", type=int, help="Compile the layer stacks with torch.compile (torch>=2.0)",
+                        default=0)
+    parser.add_argument("--script_layers", type=int, help="Compile the layer stacks with TorchScript, which fuses the"
+                        " pointwise ops", default=0)
+    parser.add_argument("--compile_forward", type=int, help="Compile the whole forward pass of every net with"
+                        " torch.compile (torch>=2.0), instead of its layer stacks", default=0)
+    parser.add_argument("--compile_mode", help="torch.compile mode of the compiled layer stacks, e.g. reduce-overhead"
+                        " to also replay them with CUDA graphs", default="default")
+    parser.add_argument("--script_actor", type=int, help="Run the actor forward pass with TorchScript", default=0)
+    parser.add_argument("--actor_cuda_graph", type=int, help="Capture the actor forward pass for acting in a CUDA graph"
+                        " (torch>=1.10)", default=0)
     parser.add_argument("--general_lr", type=float, default=0.00025)
     parser.add_argument("--batch_size", type=int, default=32)
     parser.add_argument("--optimizer", default="Adam")
@@ -89,6 +110,8 @@ def create_parser():
     parser.add_argument("--Adam_beta1", type=float)
     parser.add_argument("--Adam_beta2", type=float)
     parser.add_argument("--max_norm", type=float, default=0)
+    parser.add_argument("--accumulation_steps", type=int, help="Number of batches whose gradients are accumulated"
+                        " before each optimizer step", default=1)
     parser.add_argument("--updates_per_step", type=float, default=0.25)
     parser.add_argument("--lr_Q", type=float, default=0.0002)
     parser.add_argument("--lr_V", type=float, default=0.0002)
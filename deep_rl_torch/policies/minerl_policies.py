@@ -184,7 +184,7 @@ class MineRLObtainPolicy(MineRLPolicy):
         else:
             state_features = state
         # Preprocess:
-        action_q_vals = torch.zeros(state_features.shape[0], self.num_actions)
+        action_q_vals = torch.zeros(state_features.shape[0], self.num_actions, device=state_features.device)
         # Apply high-level policy:
         with torch.no_grad():
             action = self.decider.choose_action(state_features, calc_state_features=False)
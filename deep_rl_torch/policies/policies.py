@@ -19,6 +19,7 @@ except ImportError:
 # Internal Imports:
 from deep_rl_torch.experience_buffer import ReplayBuffer, CERWrapper, PERBuffer, RLDataset, PERDataset
 from deep_rl_torch.nn import Q, V, Actor, ProcessState, ProcessStateAction
+from deep_rl_torch.nn.nn_utils import clamp_to_bounds
 from deep_rl_torch.util import *
 from deep_rl_torch.util import apply_to_state
 
@@ -107,9 +108,9 @@ class BasePolicy:
         # Feature extractors:
         self.F_s = F_s
         self.F_sa = F_sa
-        self.state_feature_len = F_s.layers_merge[-1].out_features
+        self.state_feature_len = F_s.layers_merge.out_features
         if F_sa is not None:
-            self.state_action_feature_len = F_sa.layers_merge[-1].out_features
+            self.state_action_feature_len = F_sa.layers_merge.out_features
 
         # Set up Networks:
         self.use_half = hyperparameters["use_half"] and torch.cuda.is_available()
@@ -117,7 +118,7 @@ class BasePolicy:
         self.actor, self.Q, self.V = self.init_actor_critic(self.F_s, self.F_sa)
 
     def create_replay_buffer(self):
-        obs_sample = self.env.observation_space.sample()
+        obs_sample = sample_obs_space_for_shapes(self.env.observation_space)
         # action_sample = self.env.action_space.sample()
         action_space = self.env.action_space
         worker = self.hyperparameters["worker"]
@@ -160,8 +161,9 @@ class BasePolicy:
 
     def add_noise(self, action):
         if self.gaussian_action_noise:
-            action += torch.tensor(np.random.normal(0, self.gaussian_action_noise, len(action)), dtype=torch.float)
-            action = np.clip(action, self.action_low, self.action_high)
+            # Sample the noise on the device of the action and clamp it there:
+            action = action + torch.randn_like(action) * self.gaussian_action_noise
+            action = clamp_to_bounds(action, self.action_low, self.action_high)
         return action
 
     def choose_action(self, state, calc_state_features=True):
@@ -171,7 +173,10 @@ class BasePolicy:
                 state_features = self.F_s(state)
             else:
                 state_features = state
-            action = self.actor(state_features)
+            if self.use_actor_critic:
+                action = self.actor.act(state_features)
+            else:
+                action = self.actor(state_features)
         return action
 
     def explore(self, state, fully_random=False):
@@ -224,10 +229,10 @@ class BasePolicy:
 
     def init_critic(self, F_s, F_sa):
         if self.use_actor_critic:
-            self.state_action_feature_len = F_sa.layers_merge[-1].out_features
+            self.state_action_feature_len = F_sa.layers_merge.out_features
             input_size = self.state_action_feature_len
         else:
-            self.state_feature_len = F_s.layers_merge[-1].out_features
+            self.state_feature_len = F_s.layers_merge.out_features
             input_size = self.state_feature_len
 
         Q_net = None
@@ -323,7 +328,7 @@ class BasePolicy:
     def optimize_networks(self, transitions):
         raise NotImplementedError
 
-    def scale_gradient(self):
+    def scale_gradient(self, accumulation_steps=1):
         pass
         # TODO: implement such that all policies can do this... is it necessary??
 
@@ -1,4 +1,6 @@
 import collections
+import functools
+import inspect
 import time
 import itertools
 import os
@@ -18,7 +20,7 @@ from pytorch_memlab import profile
 from .parser import create_parser
 from .optimizers.RAdam import RAdam
 from deep_rl_torch.env_wrappers import SerialDiscreteActionWrapper, Convert2TorchWrapper, HierarchicalActionWrapper,\
-    AtariObsWrapper, DefaultWrapper
+    AtariObsWrapper, DefaultWrapper, frame_pool_size
 from .agent import Agent
 from .env_wrappers import FrameSkip, FrameStack
 from .util import display_top_memory_users, apply_rec_to_dict
@@ -178,7 +180,15 @@ def apply_parameter_changes(parameters, env, verbose):
     if parameters["optimizer"] == "RAdam":
         parameters["optimizer"] = RAdam
     elif parameters["optimizer"] == "Adam":
-        parameters["optimizer"] = torch.optim.Adam
+        # Update all params with multi-tensor kernels instead of a Python loop over the params, if this torch version
+        # supports it. The fused CUDA kernel needs torch>=2.0 and is skipped for apex amp:
+        adam_args = inspect.signature(torch.optim.Adam).parameters
+        if "fused" in adam_args and torch.cuda.is_available() and not parameters["use_half"]:
+            parameters["optimizer"] = functools.partial(torch.optim.Adam, fused=True)
+        elif "foreach" in adam_args:
+            parameters["optimizer"] = functools.partial(torch.optim.Adam, foreach=True)
+        else:
+            parameters["optimizer"] = torch.optim.Adam
     # Conv layers:
     if parameters["layers_conv"] == "mnhi_early":
         parameters["layers_conv"] = mnhi_early
@@ -336,8 +346,11 @@ class Trainer:
             wrapper = hyperparameters["convert_2_torch_wrapper"]
             env = wrapper(env, self.rgb2gray)
         if hyperparameters["frame_stack"] > 1 and hyperparameters["use_list"]:
+            # Only env transitions reference pool frames, expert states are converted without the FrameStack:
+            pool_size = frame_pool_size(hyperparameters["replay_buffer_size"], hyperparameters["frame_stack"])
             env = FrameStack(env, hyperparameters["frame_stack"], stack_dim=hyperparameters["stack_dim"],
-                             store_stacked=hyperparameters["store_stacked"])
+                             store_stacked=hyperparameters["store_stacked"], pool_size=pool_size,
+                             pool_dir=hyperparameters["frame_pool_dir"])
         if hyperparameters["action_wrapper"]:
             always_keys = hyperparameters["always_keys"]
             exclude_keys = hyperparameters["exclude_keys"]
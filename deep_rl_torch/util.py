@@ -6,6 +6,7 @@ import random
 import tracemalloc
 import linecache
 import sys
+import gym
 import torch
 
 matplotlib.use('Pdf')
@@ -36,6 +37,16 @@ def apply_to_state(func, state):
     else:
         return func(state)
 
+def sample_obs_space_for_shapes(obs_space):
+    """Return an observation of the obs_space that is only used to infer shapes. Box spaces return zeros of the right
+    shape and dtype, which avoids the random number generation of obs_space.sample(). Recurses into dict spaces."""
+    if isinstance(obs_space, gym.spaces.Box):
+        return np.zeros(obs_space.shape, dtype=obs_space.dtype)
+    sub_spaces = getattr(obs_space, "spaces", None)
+    if isinstance(sub_spaces, dict):
+        return {key: sample_obs_space_for_shapes(sub_space) for key, sub_space in sub_spaces.items()}
+    return obs_space.sample()
+
 def apply_rec_to_dict(func, tensor_dict):
     zipped = zip(tensor_dict.keys(), tensor_dict.values())
     return {
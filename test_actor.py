@@ -0,0 +1,95 @@
+import types
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from deep_rl_torch.nn import Actor, ProcessState
+from deep_rl_torch.nn.networks import smooth_l1_loss_weighted
+from test_feature_extractor import DiscreteEnv, create_hyperparameters
+
+
+def gathered_loss(output, target, pos_TDE_mask, weights, discrete):
+    # The previous actor update: gather the selected actions by boolean indexing and take the mean of their loss:
+    output, target, weights = output[pos_TDE_mask], target[pos_TDE_mask], weights[pos_TDE_mask]
+    if discrete:
+        loss = F.cross_entropy(output, target, reduction="none") * weights
+    else:
+        loss = F.smooth_l1_loss(output, target, reduction="none") * weights.unsqueeze(1)
+    return loss.mean()
+
+
+def masked_loss(output, target, pos_TDE_mask, weights, discrete):
+    sample_weights = Actor.masked_sample_weights(pos_TDE_mask.float(), weights)
+    if discrete:
+        return (F.cross_entropy(output, target, reduction="none") * sample_weights).mean()
+    return smooth_l1_loss_weighted(output, target, sample_weights.view(-1, 1))[1]
+
+
+def test_masked_sample_weights_match_gathered_loss():
+    torch.manual_seed(0)
+    batch_size, num_actions = 32, 3
+    for discrete in (False, True):
+        for _ in range(10):
+            output = torch.randn(batch_size, num_actions)
+            if discrete:
+                target = torch.randint(num_actions, (batch_size,))
+            else:
+                target = torch.randn(batch_size, num_actions)
+            TDE = torch.randn(batch_size)
+            pos_TDE_mask = TDE < 0
+            assert torch.allclose(masked_loss(output, target, pos_TDE_mask, TDE, discrete),
+                                  gathered_loss(output, target, pos_TDE_mask, TDE, discrete))
+
+
+def test_masked_sample_weights_scalar_weight():
+    pos_TDE_mask = torch.tensor([1.0, 0.0, 1.0, 0.0])
+    # Two of four actions selected, so the scalar weight is doubled for them:
+    assert torch.equal(Actor.masked_sample_weights(pos_TDE_mask.clone(), -1.0), torch.tensor([-2.0, 0.0, -2.0, 0.0]))
+
+
+def test_masked_sample_weights_nothing_selected():
+    sample_weights = Actor.masked_sample_weights(torch.zeros(8), torch.randn(8))
+    assert torch.equal(sample_weights, torch.zeros(8))
+
+
+def test_masked_sample_weights_spg():
+    # SPG selects the sampled actions that are better than the current policy and weights them by that advantage:
+    torch.manual_seed(1)
+    batch_size, num_actions = 16, 2
+    output = torch.randn(batch_size, num_actions)
+    target = torch.randn(batch_size, num_actions)
+    action_TDE = torch.randn(batch_size, 1)
+    pos_TDE_mask = (action_TDE > 0).view(-1)
+    assert torch.allclose(masked_loss(output, target, pos_TDE_mask, action_TDE.view(-1), False),
+                          gathered_loss(output, target, pos_TDE_mask, action_TDE.view(-1), False))
+
+
+class Log:
+    def add(self, *args, **kwargs):
+        pass
+
+
+def test_cacla_skips_update_without_selected_actions():
+    torch.manual_seed(2)
+    hyperparameters = create_hyperparameters(normalize_obs=0, use_CACLA_V=1, use_target_net=0,
+                                             optimizer=torch.optim.Adam,
+                                             layers_actor=[{"name": "linear", "neurons": 8, "act_func": "relu"}])
+    F_s = ProcessState(np.zeros(4, dtype=np.float32), DiscreteEnv(), Log(), "cpu", hyperparameters)
+    actor = Actor(F_s, DiscreteEnv(), Log(), "cpu", hyperparameters)
+    # optimize() reads these, but Actor.__init__ does not set them:
+    actor.F_sa = None
+    actor.log_freq = 1
+    states = torch.randn(6, 4)
+    transitions = {"state": states, "state_features": F_s(states),
+                   "action": torch.eye(2)[torch.randint(2, (6,))]}
+    # CACLA-V selects the actions with a negative TDE:
+    actor.V = types.SimpleNamespace(TDE=-torch.ones(6, 1))
+    _, loss = actor.optimize(transitions)
+    assert loss.requires_grad
+
+    # Without selected actions no loss is returned to the central optimizer, so the actor gets no gradients at all
+    # instead of zero gradients that Adam would still step with:
+    actor.V = types.SimpleNamespace(TDE=torch.ones(6, 1))
+    transitions["state_features"] = F_s(states)
+    assert actor.optimize(transitions) == (0, 0)
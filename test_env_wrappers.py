@@ -0,0 +1,161 @@
+from collections import OrderedDict
+
+import gym
+import numpy as np
+import pytest
+import torch
+
+from deep_rl_torch.env_wrappers import Convert2TorchWrapper, FramePool, HierarchicalActionWrapper, closest_option_idx, \
+    frame_pool_size, stack_pool_frames
+
+
+def map2closest_val(val, number_list):
+    # The previous per-value lookup, closest_option_idx has to match it:
+    return min(number_list, key=lambda x: abs(x - val))
+
+
+@pytest.mark.parametrize("options", [[-10, 0, 10], [-10, -5, -1, 0, 1, 5, 10]])
+def test_closest_option_idx(options):
+    options_arr = np.asarray(options)
+    # Includes the values exactly between two options, out of range values and the options themselves:
+    vals = np.concatenate([np.linspace(-20, 20, 161), np.asarray(options, dtype=np.float64),
+                           (options_arr[1:] + options_arr[:-1]) / 2])
+    expected = [map2closest_val(val, options) for val in vals]
+    assert np.array_equal(options_arr[closest_option_idx(vals, options_arr)], expected)
+    for val, expected_val in zip(vals, expected):
+        assert options[int(closest_option_idx(val, options_arr))] == expected_val
+
+
+def fill_pool(pool, num_frames, shape=(2, 3, 3)):
+    frames = [np.random.randint(0, 255, size=shape).astype(np.uint8) for _ in range(num_frames)]
+    ids = [pool.add(frame) for frame in frames]
+    return frames, ids
+
+
+@pytest.mark.parametrize("stack_dim", [0, 1, -1])
+def test_stack_pool_frames(stack_dim):
+    pool = FramePool(10)
+    frames, ids = fill_pool(pool, 4)
+    stacked = stack_pool_frames(pool[np.array(ids)], stack_dim)
+    expected = torch.cat([torch.from_numpy(frame) for frame in frames], dim=stack_dim)
+    assert np.array_equal(stacked, expected.numpy())
+
+
+def test_frame_pool_wrap_around():
+    pool = FramePool(5)
+    frames, ids = fill_pool(pool, 12)
+    # The last 5 frames are still in the pool, although their slots were reused:
+    ids = np.array(ids[-4:])
+    stacked = stack_pool_frames(pool[ids], 0)
+    expected = torch.cat([torch.from_numpy(frame) for frame in frames[-4:]], dim=0)
+    assert np.array_equal(stacked, expected.numpy())
+    assert np.array_equal(pool[ids[-1]], frames[-1])
+
+
+def test_frame_pool_stale_ids():
+    pool = FramePool(5)
+    _, ids = fill_pool(pool, 6)
+    with pytest.raises(IndexError):
+        pool[np.array(ids[:4])]
+    with pytest.raises(IndexError):
+        pool[ids[0]]
+    pool[np.array(ids[1:])]
+
+
+def test_frame_pool_size_with_one_step_episodes():
+    num_transitions, k = 20, 4
+    pool = FramePool(frame_pool_size(num_transitions, k))
+    stored = []
+    for _ in range(100):
+        # A reset frame followed by a single step, the transition references the stacks of both:
+        reset_id = pool.add(np.zeros(1))
+        step_id = pool.add(np.zeros(1))
+        stored.append((np.full(k, reset_id), np.append(np.full(k - 1, reset_id), step_id)))
+        stored = stored[-num_transitions:]
+        for state_ids, next_state_ids in stored:
+            pool[state_ids]
+            pool[next_state_ids]
+
+
+class MineRLActionEnv(gym.Env):
+    """Env with a MineRL-like dict action space, only used to build the action wrappers."""
+    action_space = gym.spaces.Dict(OrderedDict(
+        [(key, gym.spaces.Discrete(2)) for key in HierarchicalActionWrapper.BINARY_KEYS] +
+        [("camera", gym.spaces.Box(low=-180.0, high=180.0, shape=(2,), dtype=np.float32)),
+         ("place", gym.spaces.Discrete(4)), ("craft", gym.spaces.Discrete(3))]))
+    observation_space = gym.spaces.Box(low=0, high=255, shape=(4, 4, 3), dtype=np.uint8)
+
+
+def dict2idx_reference(wrapper, action_dict):
+    # The previous lookup: map the camera to the closest options and look up the whole action in dict2id_set:
+    action_dict = dict(action_dict)
+    camera = action_dict["camera"]
+    action_dict["camera"] = (map2closest_val(camera[0], wrapper.camera_x_options),
+                             map2closest_val(camera[1], wrapper.camera_y_options))
+    return wrapper.dict2id_set[wrapper._dict_key(action_dict)]
+
+
+def sample_action_dicts(wrapper, num_actions, rng):
+    """Random action dicts of the discrete actions of the wrapper, with the camera moved off its options, including
+    the ties between two options. The item actions only exist without camera movement, so their camera is kept closest
+    to zero."""
+    action_dicts = []
+    for idx in rng.integers(len(wrapper._actions), size=num_actions):
+        action_dict = dict(wrapper.action(int(idx)))
+        if any(action_dict.get(key, 0) for key in HierarchicalActionWrapper.LUT_ITEM_KEYS):
+            offsets = rng.choice([-4.9, -2.5, 0.0, 3.0, 4.9], size=2)
+        else:
+            offsets = rng.choice([-5.0, -4.9, -2.5, 0.0, 3.0, 4.9, 5.0], size=2)
+        action_dict["camera"] = (action_dict["camera"] + offsets).astype(np.float32)
+        action_dicts.append(action_dict)
+    return action_dicts
+
+
+def test_dict2idx_matches_dict2id_set():
+    wrapper = HierarchicalActionWrapper(MineRLActionEnv())
+    for idx in range(wrapper.n):
+        assert wrapper.dict2idx(wrapper.action(idx)) == idx
+    for action_dict in sample_action_dicts(wrapper, 500, np.random.default_rng(0)):
+        assert wrapper.dict2idx(action_dict) == dict2idx_reference(wrapper, action_dict)
+
+
+def test_dict2idx_unknown_actions():
+    wrapper = HierarchicalActionWrapper(MineRLActionEnv())
+    action_dict = dict(wrapper.action(0))
+    # Two item actions at once are no single discrete action, neither for the LUT nor for dict2id_set:
+    action_dict["place"], action_dict["craft"] = 1, 1
+    with pytest.raises(KeyError):
+        wrapper.dict2idx(action_dict)
+    with pytest.raises(KeyError):
+        dict2idx_reference(wrapper, action_dict)
+
+
+def test_dicts2idxs_batch():
+    wrapper = HierarchicalActionWrapper(MineRLActionEnv())
+    action_dicts = sample_action_dicts(wrapper, 500, np.random.default_rng(1))
+    # The struct of arrays layout of the MineRL data pipeline:
+    actions = {key: np.stack([action_dict[key] for action_dict in action_dicts]) for key in action_dicts[0]}
+    idxs = wrapper.dicts2idxs_batch(actions)
+    assert idxs.tolist() == [dict2idx_reference(wrapper, action_dict) for action_dict in action_dicts]
+    assert idxs.tolist() == wrapper.dicts2idxs(action_dicts)
+
+    actions["place"][3], actions["craft"][3] = 1, 1
+    with pytest.raises(KeyError):
+        wrapper.dicts2idxs_batch(actions)
+
+
+class MineRLObsEnv(gym.Env):
+    """Env with a MineRL-like dict observation space, whose inventory item counts are 0-d."""
+    observation_space = gym.spaces.Dict(OrderedDict(
+        [("inventory", gym.spaces.Dict(OrderedDict((item, gym.spaces.Box(low=0, high=2304, shape=(), dtype=np.int64))
+                                                   for item in ("dirt", "log", "planks")))),
+         ("compassAngle", gym.spaces.Box(low=-180.0, high=180.0, shape=(), dtype=np.float32))]))
+    action_space = gym.spaces.Discrete(2)
+
+
+def test_convert2torch_inventory():
+    wrapper = Convert2TorchWrapper(MineRLObsEnv(), rgb2gray=False)
+    inventory = OrderedDict([("dirt", np.array(3)), ("log", np.array(0)), ("planks", np.array(12))])
+    obs = wrapper.observation({"inventory": inventory, "compassAngle": np.array(-30.0, dtype=np.float32)})
+    assert torch.equal(obs["inventory"], torch.tensor([[3, 0, 12]]))
+    assert wrapper.observation_space["inventory"].shape == (3,)
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+
+from deep_rl_torch.nn import ProcessState
+from deep_rl_torch.parser import create_parser
+
+
+class DiscreteEnv:
+    class action_space:
+        n = 2
+
+        def __str__(self):
+            return "Discrete(2)"
+
+    action_space = action_space()
+
+
+def create_hyperparameters(**kwargs):
+    hyperparameters = vars(create_parser().parse_args([]))
+    hyperparameters.update({
+        "verbose": 0,
+        "layers_conv": [{"name": "conv", "filters": 4, "kernel_size": 3, "stride": 1},
+                        {"name": "batchnorm", "act_func": "relu"},
+                        {"name": "conv", "filters": 4, "kernel_size": 3, "stride": 2},
+                        {"name": "batchnorm", "act_func": "relu"}],
+        "layers_feature_vector": [{"name": "linear", "neurons": 8, "act_func": "relu"}],
+        "layers_feature_merge": [{"name": "linear", "neurons": 8, "act_func": "relu"}],
+        "target_network_hard_steps": 1,
+    })
+    hyperparameters.update(kwargs)
+    return hyperparameters
+
+
+def randomize_batchnorms(net):
+    for proc_dict in net.processing_list:
+        for layer in proc_dict["Layers"]:
+            if isinstance(layer, torch.nn.BatchNorm2d):
+                layer.running_mean.normal_()
+                layer.running_var.uniform_(0.5, 2.0)
+                with torch.no_grad():
+                    layer.weight.normal_()
+                    layer.bias.normal_()
+
+
+def test_fused_target_matches_unfused():
+    torch.manual_seed(0)
+    state_sample = np.zeros((3, 12, 12), dtype=np.float32)
+    F_s = ProcessState(state_sample, DiscreteEnv(), None, "cpu", create_hyperparameters(normalize_obs=0))
+    target_net = F_s.target_net
+    # Change the weights of the online net and the batchnorm stats of the target, then do a hard update:
+    randomize_batchnorms(F_s)
+    randomize_batchnorms(target_net)
+    F_s.update_targets(1)
+    fused_layers = [proc_dict["Fused"] for proc_dict in target_net.processing_list]
+    assert all(fused is not None for fused in fused_layers)
+
+    states = torch.randn(5, 3, 12, 12)
+    with torch.no_grad():
+        fused_output = target_net(states)
+        for proc_dict in target_net.processing_list:
+            proc_dict["Fused"] = None
+        unfused_output = target_net(states)
+    assert torch.allclose(fused_output, unfused_output, atol=1e-5)
+
+
+def test_no_folding_with_polyak_averaging():
+    state_sample = np.zeros((3, 12, 12), dtype=np.float32)
+    F_s = ProcessState(state_sample, DiscreteEnv(), None, "cpu",
+                       create_hyperparameters(normalize_obs=0, use_polyak_averaging=1))
+    F_s.update_targets(1)
+    assert all(proc_dict.get("Fused") is None for proc_dict in F_s.target_net.processing_list)
+
+
+def test_load_keeps_cached_params(tmp_path):
+    torch.manual_seed(0)
+    state_sample = np.zeros((3, 12, 12), dtype=np.float32)
+    F_s = ProcessState(state_sample, DiscreteEnv(), None, "cpu", create_hyperparameters(normalize_obs=0))
+    path = str(tmp_path) + "/"
+    F_s.save(path)
+    loaded_F_s = ProcessState(state_sample, DiscreteEnv(), None, "cpu", create_hyperparameters(normalize_obs=0))
+    cached_params = loaded_F_s.get_updateable_param_list()
+    loaded_F_s.load(path)
+    # The cached parameters, which the optimizers and target updates use, hold the loaded weights:
+    assert all(cached is param for cached, param in zip(cached_params, loaded_F_s.get_updateable_param_list()))
+    assert all(torch.equal(loaded, param) for loaded, param in zip(cached_params, F_s.get_updateable_param_list()))
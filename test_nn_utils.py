@@ -0,0 +1,28 @@
+import torch
+import torch.nn as nn
+
+from deep_rl_torch.nn.nn_utils import apply_layers_checkpointed
+
+
+def create_conv_layers():
+    return nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4), nn.ReLU(), nn.Conv2d(4, 4, 3), nn.BatchNorm2d(4),
+                         nn.ReLU(), nn.Conv2d(4, 2, 3), nn.ReLU())
+
+
+def test_checkpointed_layers_match_plain_forward():
+    torch.manual_seed(0)
+    layers = create_conv_layers()
+    checkpointed_layers = create_conv_layers()
+    checkpointed_layers.load_state_dict(layers.state_dict())
+    x = torch.randn(4, 3, 10, 10)
+    for _ in range(2):
+        output = layers(x)
+        output.sum().backward()
+        checkpointed_output = apply_layers_checkpointed(x, checkpointed_layers)
+        checkpointed_output.sum().backward()
+        assert torch.allclose(output, checkpointed_output)
+    # The recomputation during backward must not update the batchnorm statistics again:
+    for name, tensor in layers.state_dict().items():
+        assert torch.allclose(tensor, checkpointed_layers.state_dict()[name]), name
+    for param, checkpointed_param in zip(layers.parameters(), checkpointed_layers.parameters()):
+        assert torch.allclose(param.grad, checkpointed_param.grad, atol=1e-6)